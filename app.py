@@ -2,26 +2,93 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-from flask import Flask, request, render_template, send_file, flash, send_from_directory, session
+from flask import Flask, request, render_template, send_file, flash, send_from_directory, session, jsonify, url_for, Response, stream_with_context
 from werkzeug.utils import secure_filename
-import tempfile
-import shutil
-from utils import process_venue_file
+import json
+from jobs import submit_job, job_status, iter_job_events
+from metrics import REGISTRY
+from providers import GOOGLE_CLIENT, AMAP_CLIENT
+from storage import download_path, job_dir, remove_job, upload_path
+from utils import resolve_records
 import uuid
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Input is streamed row by row; a 16 MB sheet already holds over a million venue rows
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', '16')) * 1024 * 1024
 
-# Create a persistent downloads directory
-DOWNLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'downloads')
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+# Behind nginx/Apache, let the proxy send download files itself (X-Sendfile)
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
 
-ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
+ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
+
+# ====== JSON API settings ======
+# Optional shared secret; when set, API calls need "Authorization: Bearer <API_TOKEN>"
+API_TOKEN = os.environ.get('API_TOKEN', '')
+# A batch is resolved inside one web request, so keep it well within the gunicorn timeout
+API_MAX_RECORDS = int(os.environ.get('API_MAX_RECORDS', '1000'))
+# Rows are resolved (and streamed back) in chunks of this size
+API_CHUNK_ROWS = int(os.environ.get('API_CHUNK_ROWS', '64'))
+
+# ====== Progress stream settings ======
+# Each /events connection is closed after this long; browsers reconnect and resume automatically
+SSE_MAX_SECONDS = float(os.environ.get('SSE_MAX_SECONDS', '300'))
+SSE_RETRY_MS = 2000
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def wants_json():
+    """True when the client prefers a JSON response over an HTML page"""
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
+
+def parse_records(body: bytes, json_body: bool):
+    """
+    (city, venue) pairs from a JSON list (or {"records": [...]}) or NDJSON body
+    Raises ValueError with the offending record number for bad input
+    """
+    text = body.decode('utf-8-sig')
+    if json_body:
+        try:
+            items = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f'Invalid JSON: {e}')
+        if isinstance(items, dict):
+            items = items.get('records')
+        if not isinstance(items, list):
+            raise ValueError('Expected a JSON list of {"city", "venue"} records')
+    else:
+        items = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError(f'Invalid JSON on line {number}: {e}')
+    
+    records = []
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            raise ValueError(f'Record {number} is not an object')
+        venue = item.get('venue')
+        city = item.get('city')
+        for name, value in (('venue', venue), ('city', city)):
+            # Lists and objects would be queried as their repr; booleans are not names either
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+                raise ValueError(f'Record {number}: {name} must be text or a number')
+        if venue is None or str(venue).strip() == '':
+            raise ValueError(f'Record {number} has no venue')
+        records.append((city, venue))
+    return records
+
+def upload_error(message, code):
+    """Error response for /process: JSON for script clients, the upload page otherwise"""
+    if wants_json():
+        return jsonify({'error': message}), code
+    return render_template('index.html', error=message), code
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -30,77 +97,159 @@ def index():
 def process():
     if 'file' not in request.files:
         flash('No file uploaded')
-        return render_template('index.html', error='No file uploaded'), 400
+        return upload_error('No file uploaded', 400)
     
     file = request.files['file']
     
     if file.filename == '':
         flash('No file selected')
-        return render_template('index.html', error='No file selected'), 400
+        return upload_error('No file selected', 400)
     
     if not allowed_file(file.filename):
-        flash('Invalid file type. Please upload an Excel file (.xlsx or .xls)')
-        return render_template('index.html', error='Invalid file type'), 400
+        flash('Invalid file type. Please upload an Excel or CSV file (.xlsx, .xls or .csv)')
+        return upload_error('Invalid file type', 400)
     
     try:
-        # Create temporary directory for processing
-        temp_dir = tempfile.mkdtemp()
+        # Each upload becomes a background job; its ID doubles as the download folder
+        job_id = str(uuid.uuid4())
+        session_folder = job_dir(job_id)
         
-        # Save uploaded file
+        # Save uploaded file; outputs are written straight into the job folder
         filename = secure_filename(file.filename)
-        input_path = os.path.join(temp_dir, filename)
+        input_path = upload_path(job_id, filename)
         file.save(input_path)
         
-        # Process the file
-        result = process_venue_file(input_path, temp_dir)
+        # Queue the geocoding pass and return straight away
+        submit_job(job_id, input_path, session_folder)
+        session['download_folder'] = job_id
         
-        if result['success']:
-            # Generate unique session ID for this upload
-            session_id = str(uuid.uuid4())
-            session_folder = os.path.join(DOWNLOAD_FOLDER, session_id)
-            os.makedirs(session_folder, exist_ok=True)
-            
-            # Copy output files to persistent download folder
-            excel_src = result['excel_path']
-            kml_src = result['kml_path']
-            excel_dst = os.path.join(session_folder, result['excel_filename'])
-            kml_dst = os.path.join(session_folder, result['kml_filename'])
-            
-            shutil.copy2(excel_src, excel_dst)
-            shutil.copy2(kml_src, kml_dst)
-            
-            # Clean up temp directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            
-            # Store session info
-            session['download_folder'] = session_id
-            
-            # Return result page with simplified file names
-            return render_template('result.html', 
-                                 excel_file=result['excel_filename'],
-                                 kml_file=result['kml_filename'],
-                                 session_id=session_id)
-        else:
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return render_template('index.html', error=result['error']), 400
+        if wants_json():
+            return jsonify({
+                'job_id': job_id,
+                'status_url': url_for('status', job_id=job_id),
+                'events_url': url_for('events', job_id=job_id),
+                'result_url': url_for('result', job_id=job_id)
+            }), 202
+        
+        return render_template('processing.html', job_id=job_id, filename=filename)
             
     except Exception as e:
-        if 'temp_dir' in locals():
-            shutil.rmtree(temp_dir, ignore_errors=True)
-        return render_template('index.html', error=f'Error processing file: {str(e)}'), 500
+        if 'job_id' in locals():
+            remove_job(job_id)
+        return upload_error(f'Error processing file: {str(e)}', 500)
+
+@app.route('/status/<job_id>')
+def status(job_id):
+    info = job_status(job_id)
+    if info is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    info['downloads'] = {}
+    if info['status'] == 'done':
+        info['downloads'] = {
+            'excel': url_for('download', session_id=job_id, filename=info['excel_filename']),
+            'kml': url_for('download', session_id=job_id, filename=info['kml_filename'])
+        }
+    return jsonify(info)
+
+@app.route('/events/<job_id>')
+def events(job_id):
+    # Server-Sent Events: per-row progress, throughput and the final outcome of a job
+    if job_status(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+    except ValueError:
+        after = 0
+    
+    def generate():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        for event, data, seq in iter_job_events(job_id, after, max_seconds=SSE_MAX_SECONDS):
+            if event == 'done':
+                data['result_url'] = url_for('result', job_id=job_id)
+            yield f"id: {seq}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    response = Response(stream_with_context(generate()), content_type='text/event-stream; charset=utf-8')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/result/<job_id>')
+def result(job_id):
+    info = job_status(job_id)
+    if info is None:
+        return render_template('index.html', error='Job not found'), 404
+    
+    if info['status'] in ('failed', 'interrupted', 'expired'):
+        return render_template('index.html', error=info['error']), 400
+    
+    if info['status'] != 'done':
+        return render_template('processing.html', job_id=job_id, filename=info['filename'])
+    
+    # Return result page with simplified file names
+    return render_template('result.html',
+                         excel_file=info['excel_filename'],
+                         kml_file=info['kml_filename'],
+                         session_id=job_id)
 
 @app.route('/download/<session_id>/<filename>')
 def download(session_id, filename):
     try:
-        file_path = os.path.join(DOWNLOAD_FOLDER, session_id, filename)
+        # Names that would leave the job folder are treated as missing
+        file_path = download_path(session_id, filename)
         
-        if not os.path.exists(file_path):
+        if file_path is None:
             return f'Error: File not found', 404
         
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        # Conditional response: ETag/Last-Modified revalidation and Range requests for resumed downloads
+        return send_file(file_path, as_attachment=True, download_name=filename, conditional=True, etag=True)
     except Exception as e:
         return f'Error downloading file: {str(e)}', 500
 
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format, summed over all web workers
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/v1/resolve', methods=['POST'])
+def api_resolve():
+    if API_TOKEN and request.headers.get('Authorization') != f'Bearer {API_TOKEN}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        records = parse_records(request.get_data(), json_body=request.is_json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not records:
+        return jsonify({'error': 'No records'}), 400
+    if len(records) > API_MAX_RECORDS:
+        return jsonify({
+            'error': f'Too many records ({len(records)}); the limit is {API_MAX_RECORDS}. '
+                     f'Upload larger batches to /process as a file instead.'
+        }), 413
+    
+    def generate():
+        # One NDJSON line per record, in input order, as soon as its chunk is resolved
+        try:
+            for item in resolve_records(records, chunk_size=API_CHUNK_ROWS):
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({'error': str(e)}, ensure_ascii=False) + "\n"
+    
+    response = Response(stream_with_context(generate()), content_type='application/x-ndjson; charset=utf-8')
+    # Ask proxies not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/quota')
+def quota():
+    # Requests used today, budget left and throttle/circuit state per provider
+    return jsonify({
+        'google': GOOGLE_CLIENT.limiter.status(),
+        'amap': AMAP_CLIENT.limiter.status()
+    })
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
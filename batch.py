@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Command-line batch geocoding for bulk backfills, without the web app
+Rows of each input file are split into shards and resolved by a pool of worker processes;
+the shards are merged back in row order into one workbook and one KML per input (or one
+for the whole run with --merge), and a JSON run report is written next to the outputs
+
+Examples:
+    python batch.py venues.xlsx
+    python batch.py backfill/ --processes 8 --output-dir out/
+    python batch.py a.xlsx b.csv --merge all_venues --report out/report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+# API keys and settings from .env, as for the web app (spawned workers inherit them)
+load_dotenv()
+
+# ====== Batch settings ======
+BATCH_PROCESSES = int(os.environ.get('BATCH_PROCESSES', str(os.cpu_count() or 1)))
+# Rows sent to a worker process at a time
+BATCH_SHARD_ROWS = int(os.environ.get('BATCH_SHARD_ROWS', '2000'))
+
+INPUT_EXTENSIONS = ('.xlsx', '.xls', '.csv')
+
+
+def find_inputs(paths):
+    """Input files from file and directory arguments (directories are not searched recursively)"""
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                # Skip Excel's lock files (~$venues.xlsx)
+                if name.startswith('~$') or os.path.splitext(name)[1].lower() not in INPUT_EXTENSIONS:
+                    continue
+                inputs.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            inputs.append(path)
+        else:
+            raise FileNotFoundError(f"No such file or directory: {path}")
+    return inputs
+
+
+def worker_limits(processes: int):
+    """
+    Provider settings for each worker process, so the pool as a whole keeps the configured
+    request rates and concurrency caps (daily quotas are already shared through SQLite)
+    """
+    from providers import AMAP_CLIENT, GOOGLE_CLIENT
+
+    env = {}
+    for prefix, client in (('GOOGLE', GOOGLE_CLIENT), ('AMAP', AMAP_CLIENT)):
+        limiter = client.limiter
+        env[f'{prefix}_RPS'] = str(limiter.rate_per_sec / processes)
+        env[f'{prefix}_MAX_CONCURRENCY'] = str(max(1, limiter.max_concurrency // processes))
+    return env
+
+
+def _init_worker(env, verbose):
+    # Runs before the worker imports utils, so providers picks up its share of the limits
+    # (already divided, so a PROVIDER_PROCESSES inherited from the environment must not apply again)
+    os.environ.update(env, PROVIDER_PROCESSES='1')
+    if not verbose:
+        # The per-venue log of many processes would interleave into noise
+        sys.stdout = open(os.devnull, 'w')
+
+
+def _resolve_shard(pairs, meta):
+    """Resolve one shard in a worker process; returns its results in row order plus run counters"""
+    import utils
+
+    started = time.perf_counter()
+    resolver = utils.VenueResolver(total=len(pairs))
+    try:
+        results = [result for _, _, _, result in utils.iter_resolved(pairs, resolver, meta=meta)]
+    finally:
+        resolver.close()
+    fields = ('address', 'direct', 'embed', 'coords', 'provider')
+    return {
+        'results': [{name: result[name] for name in fields} for result in results],
+        'stats': resolver.stats(),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+class BatchOutput:
+    """Workbook and KML that shard results are appended to, in row order"""
+
+    def __init__(self, output_dir: str, excel_filename: str, kml_filename: str):
+        from kml import KML_FORMAT, KmlWriter
+        from utils import OUTPUT_COLUMNS
+        from venue_io import ExcelOutputWriter
+
+        self.excel_path = os.path.join(output_dir, excel_filename)
+        self.kml_path = os.path.join(output_dir, kml_filename)
+        self.excel_writer = ExcelOutputWriter(self.excel_path, OUTPUT_COLUMNS)
+        self.kml_writer = KmlWriter(self.kml_path, kmz=KML_FORMAT == 'kmz')
+
+    def append(self, city, place, full_name, key, result):
+        from utils import output_row
+
+        self.excel_writer.append(output_row(city, place, result), key=key, coords=result['coords'])
+        if result['coords'] is not None:
+            lat, lng = result['coords']
+            self.kml_writer.add(lat, lng, full_name, city=city)
+
+    def close(self):
+        """Finish both files; returns the KML writer's summary (placemarks, merges, pile-ups)"""
+        from kml import summary_lines
+
+        self.excel_writer.close()
+        self.kml_writer.close()
+        print(f"Generated: {self.excel_path}")
+        print(f"Generated: {self.kml_path}")
+        for line in summary_lines(self.kml_writer.summary):
+            print(line)
+        return self.kml_writer.summary
+
+    def abort(self):
+        self.excel_writer.abort()
+        self.kml_writer.abort()
+
+
+def run_file(executor, input_path: str, output: BatchOutput, shard_rows: int, in_flight: int):
+    """
+    Shard one input file across the pool and merge the results into output in row order
+    At most in_flight shards are queued at once, so memory stays flat for any file size
+    Returns the file's entry for the run report
+    """
+    from normalize import normalize_pairs
+    from utils import open_venue_input
+    from venue_io import iter_chunks
+
+    started = time.perf_counter()
+    venue_input = open_venue_input(input_path)
+    meta, total = venue_input['meta'], venue_input['total']
+    report = {
+        'input': input_path,
+        'excel_path': output.excel_path,
+        'kml_path': output.kml_path,
+        'rows': 0,
+        'resolved_rows': 0,
+        'carried_rows': 0,
+        'skipped_rows': 0,
+        'gazetteer_rows': 0,
+        'not_found_rows': 0,
+        'failed_rows': 0,
+        'failed_shards': 0,
+        'unique_queries': 0,
+        'providers': {'google': 0, 'amap': 0},
+        'errors': [],
+    }
+
+    def merge(pairs, normalized, future):
+        failed = False
+        try:
+            shard = future.result()
+        except Exception as e:
+            failed = True
+            # Rows of a failed shard are written without results so the output stays row-aligned
+            report['failed_shards'] += 1
+            report['failed_rows'] += len(pairs)
+            report['errors'].append(f"rows {report['rows'] + 1}-{report['rows'] + len(pairs)}: {e}")
+            print(f"  Shard failed ({len(pairs)} rows): {e}")
+            shard = {'results': [{'address': '', 'direct': '', 'embed': '', 'coords': None, 'provider': None}] * len(pairs),
+                     'stats': {}}
+        stats = shard['stats']
+        report['carried_rows'] += stats.get('carried_rows', 0)
+        report['skipped_rows'] += stats.get('skipped_rows', 0)
+        report['gazetteer_rows'] += stats.get('gazetteer_rows', 0)
+        report['unique_queries'] += stats.get('unique_queries', 0)
+        rows = zip(pairs, normalized['query'], normalized['key'], normalized['blank'], shard['results'])
+        for item, full_name, key, blank, result in rows:
+            output.append(item[0], item[1], full_name, key, result)
+            if result['provider'] is not None:
+                report['providers'][result['provider']] += 1
+            elif not result['direct'] and not failed and not blank:
+                report['not_found_rows'] += 1
+        report['rows'] += len(pairs)
+
+        elapsed = time.perf_counter() - started
+        print(f"{os.path.basename(input_path)}: {report['rows']}/{max(total or 0, report['rows'])} rows, "
+              f"{report['rows'] / elapsed if elapsed else 0.0:.1f} rows/s")
+
+    pending = deque()
+    for pairs in iter_chunks(venue_input['pairs'], shard_rows):
+        # Query texts and keys for the output; the worker normalizes its shard the same way
+        normalized = normalize_pairs([item[0] for item in pairs], [item[1] for item in pairs])
+        shard_meta = None
+        if meta:
+            # Each shard only gets the carry-over entries for its own rows
+            shard_meta = {key: meta[key] for key in normalized['key'] if key in meta}
+        pending.append((pairs, normalized, executor.submit(_resolve_shard, pairs, shard_meta)))
+        while len(pending) >= in_flight:
+            merge(*pending.popleft())
+    while pending:
+        merge(*pending.popleft())
+
+    seconds = time.perf_counter() - started
+    report['resolved_rows'] = report['rows'] - sum(
+        report[name] for name in ('carried_rows', 'skipped_rows', 'gazetteer_rows', 'failed_rows'))
+    report['seconds'] = round(seconds, 3)
+    report['rows_per_sec'] = round(report['rows'] / seconds, 2) if seconds else 0.0
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='Excel/CSV files or directories of them')
+    parser.add_argument('--output-dir', default='batch_output', help='where outputs and the report go')
+    parser.add_argument('--processes', type=int, default=BATCH_PROCESSES, help='worker processes')
+    parser.add_argument('--shard-rows', type=int, default=BATCH_SHARD_ROWS, help='rows per shard')
+    parser.add_argument('--merge', metavar='NAME',
+                        help='write all inputs into NAME_output.xlsx and one KML instead of one pair per input')
+    parser.add_argument('--report', help='run report path (default: OUTPUT_DIR/batch_report.json)')
+    parser.add_argument('--verbose', action='store_true', help='show the per-venue log of the workers')
+    args = parser.parse_args(argv)
+
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        parser.error('no .xlsx, .xls or .csv files found')
+    processes = max(1, args.processes)
+
+    from utils import AMAP_API_KEY, GOOGLE_API_KEY, output_filenames
+
+    # The workers' log is silenced, so a missing key would otherwise only show as "not found" rows
+    if not GOOGLE_API_KEY:
+        print("Error: GOOGLE_API_KEY is not set (add it to .env or the environment)", file=sys.stderr)
+        return 2
+    if not AMAP_API_KEY:
+        print("Warning: AMAP_API_KEY is not set; venues Google cannot place precisely get no Amap fallback",
+              file=sys.stderr)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = args.report or os.path.join(args.output_dir, 'batch_report.json')
+
+    limits = worker_limits(processes)
+    print(f"Batch: {len(inputs)} file(s), {processes} processes, {args.shard_rows} rows per shard")
+    print("Per-process limits: " + ", ".join(f"{name}={value}" for name, value in limits.items()))
+
+    started_at = time.time()
+    started = time.perf_counter()
+    files = []
+    merged = None
+    merged_kml = None
+    # Workers are spawned, not forked, so they import the providers with their share of the limits
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(limits, args.verbose),
+    )
+    try:
+        if args.merge:
+            merged = BatchOutput(args.output_dir, *output_filenames(args.merge))
+        for input_path in inputs:
+            output = merged
+            if output is None:
+                output = BatchOutput(args.output_dir, *output_filenames(input_path))
+            try:
+                files.append(run_file(executor, input_path, output, args.shard_rows, processes * 2))
+            except Exception as e:
+                print(f"Error processing {input_path}: {e}")
+                files.append({'input': input_path, 'error': str(e)})
+                if merged is None:
+                    output.abort()
+                continue
+            except BaseException:
+                if merged is None:
+                    output.abort()
+                raise
+            if merged is None:
+                files[-1]['kml'] = output.close()
+        if merged is not None:
+            merged_kml = merged.close()
+    except BaseException:
+        if merged is not None:
+            merged.abort()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+    seconds = time.perf_counter() - started
+    done = [entry for entry in files if 'error' not in entry]
+    totals = {name: sum(entry[name] for entry in done)
+              for name in ('rows', 'resolved_rows', 'carried_rows', 'skipped_rows', 'gazetteer_rows',
+                           'not_found_rows', 'failed_rows')}
+    totals.update({
+        'failed_files': len(files) - len(done),
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(totals['rows'] / seconds, 2) if seconds else 0.0,
+    })
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started_at)),
+        'processes': processes,
+        'shard_rows': args.shard_rows,
+        'per_process_limits': limits,
+        'files': files,
+        'totals': totals,
+    }
+    if merged_kml is not None:
+        report['kml'] = merged_kml
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"Done: {totals['rows']} rows in {seconds:.1f}s ({totals['rows_per_sec']} rows/s), "
+          f"{totals['not_found_rows']} not found, {totals['failed_rows']} failed rows, "
+          f"{totals['failed_files']} failed files")
+    print(f"Report: {report_path}")
+    return 1 if totals['failed_rows'] or totals['failed_files'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
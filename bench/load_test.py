@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Load test of the web app under gunicorn against the local mock Google/Amap server
+Each simulated user does what the upload page does: POST /process, follow /events until the
+job is done, then download the workbook. A probe requests /status alongside to show whether
+the server still answers while users are waiting on providers.
+
+Examples:
+    python bench/load_test.py --worker-class sync gthread gevent
+    python bench/load_test.py --users 12 --rows 200 --worker-class gevent --env JOB_WORKERS=8
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_providers import MockProviderServer, add_config_arguments, config_from_args  # noqa: E402
+from run_bench import make_sheet, percentile  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(worker_class: str, work_dir: str, provider_env: dict, extra_env):
+    port = free_port()
+    env = dict(os.environ)
+    env.update(provider_env)
+    env.update({
+        'GUNICORN_BIND': f"127.0.0.1:{port}",
+        'GUNICORN_WORKER_CLASS': worker_class,
+        'DATA_DIR': os.path.join(work_dir, 'data'),
+        'DOWNLOAD_DIR': os.path.join(work_dir, 'downloads'),
+        # Every user uploads a similar sheet: keep runs cold and jobs independent
+        'GEOCODE_CACHE': '0',
+        'GAZETTEER': '0',
+        'CHECKPOINTS': '0',
+    })
+    env.update(item.split('=', 1) for item in extra_env)
+    log = open(os.path.join(work_dir, 'gunicorn.log'), 'w')
+    proc = subprocess.Popen(['gunicorn', 'app:app'], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited, see {log.name}")
+        try:
+            requests.get(base_url + '/quota', timeout=1)
+            return proc, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def follow_events(url: str, timeout: float):
+    """Read a /events stream until the job's final event; returns that event's name"""
+    event = None
+    with requests.get(url, stream=True, timeout=timeout) as r:
+        for line in r.iter_lines(decode_unicode=True):
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: ') and event in ('done', 'failed', 'interrupted', 'expired'):
+                return event
+    return None
+
+
+def run_user(base_url: str, sheet: bytes, timeout: float, report: dict):
+    started = time.perf_counter()
+    try:
+        r = requests.post(base_url + '/process', files={'file': ('venues.xlsx', sheet)},
+                          headers={'Accept': 'application/json'}, timeout=timeout)
+        report['accept_s'] = time.perf_counter() - started
+        r.raise_for_status()
+        job = r.json()
+        outcome = None
+        while outcome is None and time.perf_counter() - started < timeout:
+            # The server closes long streams; reconnecting is what EventSource does
+            outcome = follow_events(base_url + job['events_url'], timeout)
+        if outcome != 'done':
+            raise RuntimeError(f"job ended with {outcome}")
+        status = requests.get(base_url + job['status_url'], timeout=timeout).json()
+        requests.get(base_url + status['downloads']['excel'], timeout=timeout).raise_for_status()
+        report['done_s'] = time.perf_counter() - started
+    except Exception as e:
+        report['error'] = str(e)
+
+
+def probe(base_url: str, stop: threading.Event, latencies: list, interval: float = 0.25):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            requests.get(base_url + '/status/probe', timeout=60)
+            latencies.append(time.perf_counter() - started)
+        except requests.RequestException:
+            latencies.append(60.0)
+        stop.wait(interval)
+
+
+def run_scenario(worker_class: str, args, server: MockProviderServer, sheet: bytes):
+    with tempfile.TemporaryDirectory() as work_dir:
+        proc, base_url = start_gunicorn(worker_class, work_dir, server.env(), args.env)
+        try:
+            server.take_counts()
+            reports = [{} for _ in range(args.users)]
+            stop = threading.Event()
+            probe_latencies = []
+            prober = threading.Thread(target=probe, args=(base_url, stop, probe_latencies))
+            prober.start()
+            started = time.perf_counter()
+            users = [threading.Thread(target=run_user, args=(base_url, sheet, args.timeout, report))
+                     for report in reports]
+            for user in users:
+                user.start()
+                time.sleep(args.stagger)
+            for user in users:
+                user.join()
+            wall = time.perf_counter() - started
+            stop.set()
+            prober.join()
+            counts = server.take_counts()
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    ok = [report for report in reports if 'error' not in report]
+    accepts = [report['accept_s'] for report in reports if 'accept_s' in report]
+    dones = [report['done_s'] for report in ok]
+    return {
+        'worker_class': worker_class,
+        'users': args.users,
+        'rows_per_user': args.rows,
+        'failed_users': len(reports) - len(ok),
+        'errors': sorted({report['error'] for report in reports if 'error' in report}),
+        'wall_s': wall,
+        'rows_per_sec': len(ok) * args.rows / wall if wall else 0.0,
+        'accept_p50_ms': percentile(accepts, 50) * 1000,
+        'accept_max_ms': max(accepts, default=0.0) * 1000,
+        'done_p50_s': percentile(dones, 50),
+        'done_max_s': max(dones, default=0.0),
+        'probe_p50_ms': percentile(probe_latencies, 50) * 1000,
+        'probe_p95_ms': percentile(probe_latencies, 95) * 1000,
+        'probe_max_ms': max(probe_latencies, default=0.0) * 1000,
+        'google_calls': counts['google'],
+        'amap_calls': counts['amap'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worker-class', nargs='+', default=['sync', 'gthread'],
+                        help='gunicorn worker classes to compare (sync, gthread, gevent)')
+    parser.add_argument('--users', type=int, default=8, help='simultaneous users')
+    parser.add_argument('--rows', type=int, default=100, help='rows in each uploaded sheet')
+    parser.add_argument('--stagger', type=float, default=0.1, help='seconds between user starts')
+    parser.add_argument('--timeout', type=float, default=600, help='give up on a user after this long')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra app/gunicorn setting (repeatable), e.g. JOB_WORKERS=8')
+    parser.add_argument('--json', help='also write the results to this file')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sheet_dir:
+        path = os.path.join(sheet_dir, 'venues.xlsx')
+        make_sheet(path, args.rows, 0.0)
+        with open(path, 'rb') as f:
+            sheet = f.read()
+
+    server = MockProviderServer(config_from_args(args)).start()
+    print(f"Mock providers on {server.base_url} (latency {args.latency_ms}±{args.jitter_ms} ms); "
+          f"{args.users} users x {args.rows} rows" + (f"; {' '.join(args.env)}" if args.env else ''))
+    header = f"{'worker':>8} {'wall s':>8} {'rows/s':>8} {'accept p50':>11} {'accept max':>11} " \
+             f"{'done p50':>9} {'done max':>9} {'probe p95':>10} {'probe max':>10} {'failed':>7}"
+    print(header)
+    print('-' * len(header))
+    results = []
+    try:
+        for worker_class in args.worker_class:
+            result = run_scenario(worker_class, args, server, sheet)
+            results.append(result)
+            print(f"{worker_class:>8} {result['wall_s']:>8.1f} {result['rows_per_sec']:>8.1f} "
+                  f"{result['accept_p50_ms']:>9.0f}ms {result['accept_max_ms']:>9.0f}ms "
+                  f"{result['done_p50_s']:>8.1f}s {result['done_max_s']:>8.1f}s "
+                  f"{result['probe_p95_ms']:>8.0f}ms {result['probe_max_ms']:>8.0f}ms {result['failed_users']:>7}")
+            for error in result['errors']:
+                print(f"         error: {error}")
+    finally:
+        server.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Google Geocoding and Amap place/text APIs
+Answers are deterministic per query; latency and error rates are configurable
+
+Run standalone:
+    python bench/mock_providers.py --port 8765 --latency-ms 80 --approximate-ratio 0.3
+then point the app at it:
+    GOOGLE_GEOCODE_URL=http://127.0.0.1:8765/maps/api/geocode/json
+    AMAP_PLACE_URL=http://127.0.0.1:8765/v3/place/text
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockConfig:
+    def __init__(self, latency_ms=50.0, jitter_ms=20.0, error_rate=0.0, approximate_ratio=0.3,
+                 google_zero_ratio=0.05, amap_hit_ratio=0.8, amap_rate_limit_ratio=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        # Fraction of requests answered with HTTP 500
+        self.error_rate = error_rate
+        # Fraction of Google answers with location_type APPROXIMATE
+        self.approximate_ratio = approximate_ratio
+        # Fraction of Google answers with ZERO_RESULTS
+        self.google_zero_ratio = google_zero_ratio
+        # Fraction of Amap searches that find a POI
+        self.amap_hit_ratio = amap_hit_ratio
+        # Fraction of Amap requests answered with CUQPS_HAS_EXCEEDED_THE_LIMIT
+        self.amap_rate_limit_ratio = amap_rate_limit_ratio
+
+
+def _fraction(text: str, salt: str) -> float:
+    """Stable pseudo-random number in [0, 1) for a query"""
+    digest = hashlib.md5(f"{salt}:{text}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def google_answer(address: str, config: MockConfig):
+    roll = _fraction(address, 'google')
+    if roll < config.google_zero_ratio:
+        return {'status': 'ZERO_RESULTS', 'results': []}
+    approximate = roll < config.google_zero_ratio + config.approximate_ratio
+    lat = 22.0 + _fraction(address, 'lat') * 18.0
+    lng = 102.0 + _fraction(address, 'lng') * 20.0
+    return {
+        'status': 'OK',
+        'results': [{
+            'formatted_address': address,
+            'place_id': 'mock_' + hashlib.md5(address.encode('utf-8')).hexdigest()[:20],
+            'geometry': {
+                'location': {'lat': round(lat, 6), 'lng': round(lng, 6)},
+                'location_type': 'APPROXIMATE' if approximate else 'ROOFTOP',
+            },
+        }],
+    }
+
+
+def amap_answer(keywords: str, config: MockConfig):
+    if random.random() < config.amap_rate_limit_ratio:
+        return {'status': '0', 'info': 'CUQPS_HAS_EXCEEDED_THE_LIMIT', 'infocode': '10019', 'count': '0', 'pois': []}
+    if _fraction(keywords, 'amap') >= config.amap_hit_ratio:
+        return {'status': '1', 'info': 'OK', 'count': '0', 'pois': []}
+    parts = keywords.split()
+    lat = 22.0 + _fraction(keywords, 'amap_lat') * 18.0
+    lng = 102.0 + _fraction(keywords, 'amap_lng') * 20.0
+    return {
+        'status': '1',
+        'info': 'OK',
+        'count': '1',
+        'pois': [{
+            'name': parts[-1] if parts else keywords,
+            'address': f"{int(_fraction(keywords, 'no') * 999) + 1}号",
+            'pname': '模拟省',
+            'cityname': parts[0] if len(parts) > 1 else '模拟市',
+            'adname': '模拟区',
+            'location': f"{lng:.6f},{lat:.6f}",
+        }],
+    }
+
+
+def make_handler(config: MockConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Keep-alive responses are written in pieces; with Nagle's algorithm each one would wait
+        # for the client's delayed ACK (~40 ms) and skew every latency figure
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            provider = 'google' if url.path.endswith('/geocode/json') else 'amap'
+            with self.server.counts_lock:
+                self.server.counts[provider] += 1
+
+            delay = max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000.0
+            time.sleep(delay)
+
+            if random.random() < config.error_rate:
+                self._send(500, {'error': 'mock server error'})
+                return
+            if url.path.endswith('/geocode/json'):
+                self._send(200, google_answer(params.get('address', ''), config))
+            elif url.path.endswith('/place/text'):
+                self._send(200, amap_answer(params.get('keywords', ''), config))
+            else:
+                self._send(404, {'error': 'unknown endpoint'})
+
+        def _send(self, code, body):
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class MockProviderServer:
+    """Runs the stand-in server on a background thread"""
+
+    def __init__(self, config: MockConfig, host: str = '127.0.0.1', port: int = 0):
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(config))
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 256
+        self.httpd.counts = {'google': 0, 'amap': 0}
+        self.httpd.counts_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        """Environment variables that point the app at this server"""
+        return {
+            'GOOGLE_GEOCODE_URL': f"{self.base_url}/maps/api/geocode/json",
+            'AMAP_PLACE_URL': f"{self.base_url}/v3/place/text",
+            'GOOGLE_API_KEY': 'mock-google-key',
+            'AMAP_API_KEY': 'mock-amap-key',
+        }
+
+    def take_counts(self):
+        """Requests served per provider since the last call"""
+        with self.httpd.counts_lock:
+            counts = dict(self.httpd.counts)
+            self.httpd.counts.update(google=0, amap=0)
+        return counts
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='mean response latency')
+    parser.add_argument('--jitter-ms', type=float, default=20.0, help='latency standard deviation')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of HTTP 500 answers')
+    parser.add_argument('--approximate-ratio', type=float, default=0.3, help='fraction of APPROXIMATE Google answers')
+    parser.add_argument('--google-zero-ratio', type=float, default=0.05, help='fraction of ZERO_RESULTS Google answers')
+    parser.add_argument('--amap-hit-ratio', type=float, default=0.8, help='fraction of Amap searches with a POI')
+    parser.add_argument('--amap-rate-limit-ratio', type=float, default=0.0, help='fraction of Amap QPS-limit answers')
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        approximate_ratio=args.approximate_ratio,
+        google_zero_ratio=args.google_zero_ratio,
+        amap_hit_ratio=args.amap_hit_ratio,
+        amap_rate_limit_ratio=args.amap_rate_limit_ratio,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockProviderServer(config_from_args(args), host=args.host, port=args.port)
+    print(f"Mock Google/Amap server on {server.base_url}")
+    for name, value in server.env().items():
+        print(f"  {name}={value}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
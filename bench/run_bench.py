@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Offline throughput benchmark for process_venue_file
+Starts the local mock Google/Amap server, generates synthetic venue sheets and runs each
+one end to end in a fresh process, reporting rows/sec, per-row latency and peak memory
+
+Examples:
+    python bench/run_bench.py
+    python bench/run_bench.py --rows 100 1000 10000 100000 --latency-ms 80 --error-rate 0.01
+    python bench/run_bench.py --amap-rps 3 --google-rps 40   # production rate limits
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_providers import MockProviderServer, add_config_arguments, config_from_args  # noqa: E402
+
+CITIES = ['南京', '上海', '北京', '深圳', '杭州', '成都', '重庆', '西安', '广州', '苏州',
+          '武汉', '长沙', '厦门', '青岛', '天津', '昆明', '大理', '丽江', '桂林', '三亚']
+PLACE_WORDS = ['书店', '咖啡', '公园', '博物馆', '餐厅', '茶馆', '酒店', '市场', '画廊', '剧场']
+
+
+def make_sheet(path: str, rows: int, duplicate_ratio: float):
+    """Write a synthetic 城市/景点 sheet; duplicate_ratio of the rows repeat earlier venues"""
+    from openpyxl import Workbook
+
+    unique = max(1, int(rows * (1 - duplicate_ratio)))
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    ws.append(['城市', '景点'])
+    for i in range(rows):
+        n = i % unique
+        ws.append([CITIES[n % len(CITIES)], f"{PLACE_WORDS[n % len(PLACE_WORDS)]}{n}号"])
+    wb.save(path)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_child(input_path: str, output_dir: str):
+    """Run one file through process_venue_file in this process and print a JSON report"""
+    import contextlib
+    import io
+    import resource
+    import threading
+
+    import utils
+
+    latencies = []
+    lock = threading.Lock()
+    resolve_venue = utils.resolve_venue
+
+    def timed_resolve_venue(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return resolve_venue(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    utils.resolve_venue = timed_resolve_venue
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = utils.process_venue_file(input_path, output_dir)
+    elapsed = time.perf_counter() - start
+
+    if not result['success']:
+        print(json.dumps({'error': result['error']}))
+        return
+    stats = result['stats']
+    print(json.dumps({
+        'rows': stats['rows'],
+        'unique_queries': stats['unique_queries'],
+        'hedges': stats.get('hedges'),
+        'seconds': elapsed,
+        'latencies_ms': [round(value * 1000, 3) for value in latencies],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000], help='sheet sizes to run')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2, help='fraction of rows repeating a venue')
+    parser.add_argument('--google-rps', default='0', help='GOOGLE_RPS for the run (0 = unlimited)')
+    parser.add_argument('--amap-rps', default='0', help='AMAP_RPS for the run (0 = unlimited)')
+    parser.add_argument('--cache', action='store_true', help='keep the geocode cache on (off = cold runs)')
+    parser.add_argument('--hedge-mode', default='off', choices=['off', 'cjk', 'adaptive'], help='HEDGE_MODE for the run')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra app setting for the run (repeatable), e.g. AMAP_MAX_CONCURRENCY=6')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', nargs=2, metavar=('INPUT', 'OUTPUT_DIR'), help=argparse.SUPPRESS)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    server = MockProviderServer(config_from_args(args)).start()
+    print(f"Mock providers on {server.base_url} "
+          f"(latency {args.latency_ms}±{args.jitter_ms} ms, errors {args.error_rate:.1%}, "
+          f"APPROXIMATE {args.approximate_ratio:.0%})")
+    header = f"{'rows':>8} {'unique':>8} {'seconds':>9} {'rows/s':>9} {'p50 ms':>8} {'p95 ms':>8} " \
+             f"{'google':>8} {'amap':>8} {'peak MB':>8}"
+    print(header)
+    print('-' * len(header))
+
+    reports = []
+    try:
+        for rows in args.rows:
+            with tempfile.TemporaryDirectory() as work_dir:
+                input_path = os.path.join(work_dir, f"bench_{rows}.xlsx")
+                make_sheet(input_path, rows, args.duplicate_ratio)
+
+                env = dict(os.environ)
+                env.update(server.env())
+                env.update({
+                    'DATA_DIR': os.path.join(work_dir, 'data'),
+                    'GEOCODE_CACHE': '1' if args.cache else '0',
+                    'GOOGLE_RPS': str(args.google_rps),
+                    'AMAP_RPS': str(args.amap_rps),
+                    'HEDGE_MODE': args.hedge_mode,
+                })
+                env.update(item.split('=', 1) for item in args.env)
+                server.take_counts()
+                proc = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--child', input_path, work_dir],
+                    cwd=ROOT, env=env, capture_output=True, text=True,
+                )
+                counts = server.take_counts()
+
+            lines = proc.stdout.strip().splitlines()
+            report = json.loads(lines[-1]) if lines else {'error': proc.stderr.strip()[-500:]}
+            if 'error' in report:
+                print(f"{rows:>8} failed: {report['error']}")
+                continue
+
+            latencies = report.pop('latencies_ms')
+            report.update({
+                'rows_per_sec': report['rows'] / report['seconds'] if report['seconds'] else 0.0,
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'google_calls': counts['google'],
+                'amap_calls': counts['amap'],
+            })
+            reports.append(report)
+            print(f"{report['rows']:>8} {report['unique_queries']:>8} {report['seconds']:>9.2f} "
+                  f"{report['rows_per_sec']:>9.1f} {report['p50_ms']:>8.1f} {report['p95_ms']:>8.1f} "
+                  f"{report['google_calls']:>8} {report['amap_calls']:>8} {report['peak_rss_mb']:>8.1f}")
+    finally:
+        server.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': reports}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import time
+
+from localdb import DATA_DIR, LocalDB
+
+# ====== Checkpoint settings ======
+CHECKPOINTS_ENABLED = os.environ.get('CHECKPOINTS', '1') != '0'
+CHECKPOINT_DB_PATH = os.environ.get('CHECKPOINT_DB_PATH', os.path.join(DATA_DIR, 'checkpoints.sqlite3'))
+# Checkpoints of runs that never finished are dropped after this many days
+CHECKPOINT_TTL_DAYS = float(os.environ.get('CHECKPOINT_TTL_DAYS', '7'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoint_rows (
+    file_hash TEXT NOT NULL,
+    row_idx INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (file_hash, row_idx)
+);
+CREATE TABLE IF NOT EXISTS checkpoint_runs (
+    file_hash TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+);
+"""
+
+_db = LocalDB(CHECKPOINT_DB_PATH, _SCHEMA)
+
+
+def file_hash(path: str) -> str:
+    """SHA-256 of a file's contents, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """Per-row results of one input file, so an interrupted run can resume where it stopped"""
+
+    def __init__(self, file_hash: str):
+        self.file_hash = file_hash
+        conn = _db.connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO checkpoint_runs (file_hash, updated_at) VALUES (?, ?)",
+            (file_hash, time.time()),
+        )
+        self.resumable = conn.execute(
+            "SELECT COUNT(*) FROM checkpoint_rows WHERE file_hash = ?", (file_hash,)
+        ).fetchone()[0]
+
+    def load(self, start: int, end: int):
+        """Stored results for rows start..end-1, as {row_idx: result}"""
+        if not self.resumable:
+            return {}
+        rows = _db.connect().execute(
+            "SELECT row_idx, result FROM checkpoint_rows WHERE file_hash = ? AND row_idx >= ? AND row_idx < ?",
+            (self.file_hash, start, end),
+        ).fetchall()
+        loaded = {}
+        for row_idx, result in rows:
+            result = json.loads(result)
+            for key in ('coords', 'gcj02'):
+                if result.get(key) is not None:
+                    result[key] = tuple(result[key])
+            loaded[row_idx] = result
+        return loaded
+
+    def record(self, rows):
+        """Durably store [(row_idx, result), ...] as soon as they are resolved"""
+        conn = _db.connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO checkpoint_rows (file_hash, row_idx, result) VALUES (?, ?, ?)",
+                [(self.file_hash, row_idx, json.dumps(result, ensure_ascii=False)) for row_idx, result in rows],
+            )
+
+    def finish(self):
+        """The run completed: its rows are no longer needed"""
+        conn = _db.connect()
+        conn.execute("DELETE FROM checkpoint_rows WHERE file_hash = ?", (self.file_hash,))
+        conn.execute("DELETE FROM checkpoint_runs WHERE file_hash = ?", (self.file_hash,))
+
+
+def open_checkpoint(input_path: str):
+    """Checkpoint for an input file (None when disabled); also drops stale checkpoints"""
+    if not CHECKPOINTS_ENABLED:
+        return None
+    conn = _db.connect()
+    cutoff = time.time() - CHECKPOINT_TTL_DAYS * 86400
+    stale = [row[0] for row in conn.execute(
+        "SELECT file_hash FROM checkpoint_runs WHERE updated_at < ?", (cutoff,)
+    )]
+    for stale_hash in stale:
+        conn.execute("DELETE FROM checkpoint_rows WHERE file_hash = ?", (stale_hash,))
+        conn.execute("DELETE FROM checkpoint_runs WHERE file_hash = ?", (stale_hash,))
+    return Checkpoint(file_hash(input_path))
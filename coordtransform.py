@@ -0,0 +1,77 @@
+"""
+GCJ-02 (Amap / "Mars" coordinates) <-> WGS-84 conversion, vectorized with NumPy
+Amap returns GCJ-02 for locations in mainland China; Google Maps and KML expect WGS-84
+"""
+import numpy as np
+
+# Krasovsky 1940 ellipsoid parameters used by the GCJ-02 offset
+_A = 6378245.0
+_EE = 0.00669342162296594323
+_EARTH_RADIUS_M = 6371008.8
+
+
+def _transform_lat(x, y):
+    ret = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * np.sqrt(np.abs(x))
+    ret += (20.0 * np.sin(6.0 * x * np.pi) + 20.0 * np.sin(2.0 * x * np.pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(y * np.pi) + 40.0 * np.sin(y / 3.0 * np.pi)) * 2.0 / 3.0
+    ret += (160.0 * np.sin(y / 12.0 * np.pi) + 320.0 * np.sin(y * np.pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def _transform_lng(x, y):
+    ret = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * np.sqrt(np.abs(x))
+    ret += (20.0 * np.sin(6.0 * x * np.pi) + 20.0 * np.sin(2.0 * x * np.pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(x * np.pi) + 40.0 * np.sin(x / 3.0 * np.pi)) * 2.0 / 3.0
+    ret += (150.0 * np.sin(x / 12.0 * np.pi) + 300.0 * np.sin(x / 30.0 * np.pi)) * 2.0 / 3.0
+    return ret
+
+
+def out_of_china(lng, lat):
+    """True where the point is outside the rough mainland bounding box (no GCJ-02 offset applied)"""
+    lng = np.asarray(lng, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    return (lng < 72.004) | (lng > 137.8347) | (lat < 0.8293) | (lat > 55.8271)
+
+
+def _offset(lng, lat):
+    """GCJ-02 offset (dlng, dlat) in degrees at a WGS-84 point"""
+    dlat = _transform_lat(lng - 105.0, lat - 35.0)
+    dlng = _transform_lng(lng - 105.0, lat - 35.0)
+    radlat = lat / 180.0 * np.pi
+    magic = 1 - _EE * np.sin(radlat) ** 2
+    sqrtmagic = np.sqrt(magic)
+    dlat = (dlat * 180.0) / ((_A * (1 - _EE)) / (magic * sqrtmagic) * np.pi)
+    dlng = (dlng * 180.0) / (_A / sqrtmagic * np.cos(radlat) * np.pi)
+    return dlng, dlat
+
+
+def wgs84_to_gcj02(lng, lat):
+    """Convert WGS-84 arrays to GCJ-02; points outside China are returned unchanged"""
+    lng = np.asarray(lng, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    dlng, dlat = _offset(lng, lat)
+    outside = out_of_china(lng, lat)
+    return np.where(outside, lng, lng + dlng), np.where(outside, lat, lat + dlat)
+
+
+def gcj02_to_wgs84(lng, lat, iterations: int = 3):
+    """
+    Convert GCJ-02 arrays to WGS-84; points outside China are returned unchanged
+    The offset has no closed-form inverse, so a few fixed-point iterations bring the error well under 1 m
+    """
+    lng = np.asarray(lng, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    wgs_lng, wgs_lat = lng.copy(), lat.copy()
+    for _ in range(iterations):
+        gcj_lng, gcj_lat = wgs84_to_gcj02(wgs_lng, wgs_lat)
+        wgs_lng = wgs_lng - (gcj_lng - lng)
+        wgs_lat = wgs_lat - (gcj_lat - lat)
+    outside = out_of_china(lng, lat)
+    return np.where(outside, lng, wgs_lng), np.where(outside, lat, wgs_lat)
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in metres between arrays of points"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * _EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
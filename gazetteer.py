@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+Local gazetteer of every venue resolved so far, so known venues are answered without provider calls
+Entries are added as rows resolve and can be bulk-imported from archived output workbooks and KML files
+
+Examples:
+    python gazetteer.py import archive/
+    python gazetteer.py search 先锋书店 --city 南京
+    python gazetteer.py stats
+"""
+import argparse
+import difflib
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zipfile
+from bisect import bisect_left
+from collections import Counter
+from xml.etree import ElementTree
+
+from localdb import DATA_DIR, LocalDB
+from metrics import GAZETTEER_LOOKUPS
+from normalize import normalize_pairs, normalize_query
+from venue_io import iter_chunks, open_venue_rows, read_output_meta, recorded_coords
+
+# ====== Gazetteer settings ======
+GAZETTEER_ENABLED = os.environ.get('GAZETTEER', '1') != '0'
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', os.path.join(DATA_DIR, 'gazetteer.sqlite3'))
+# Which rows are answered from the gazetteer: 'exact' (same normalized city and venue), 'prefix'
+# (also a venue name that begins exactly one known venue of the city) or 'fuzzy' (also the one
+# clearly closest known name of the city); looser matches save calls but may pick a sibling venue
+GAZETTEER_MATCH = os.environ.get('GAZETTEER_MATCH', 'exact').lower()
+# Shorter venue names are only matched exactly
+GAZETTEER_MIN_PREFIX = int(os.environ.get('GAZETTEER_MIN_PREFIX', '4'))
+GAZETTEER_FUZZY_RATIO = float(os.environ.get('GAZETTEER_FUZZY_RATIO', '0.9'))
+# Entries not confirmed for this many days no longer answer rows (0 = never stale); by default the
+# geocode cache's TTL, so a known venue is not trusted for longer than a cached answer would be
+GAZETTEER_TTL_DAYS = float(os.environ.get('GAZETTEER_TTL_DAYS', os.environ.get('GEOCODE_CACHE_TTL_DAYS', '30')))
+# How often a process picks up entries that other workers added
+GAZETTEER_REFRESH_SECONDS = float(os.environ.get('GAZETTEER_REFRESH_SECONDS', '30'))
+
+IMPORT_EXTENSIONS = ('.xlsx', '.kml', '.kmz')
+
+# Known names sharing the most bigrams with a row are scored for fuzzy matches
+_FUZZY_CANDIDATES = 20
+# Entries are reloaded with this much overlap, for rows another process committed late
+_REFRESH_OVERLAP = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gazetteer (
+    key TEXT PRIMARY KEY,
+    city TEXT NOT NULL,
+    name TEXT NOT NULL,
+    place_id TEXT,
+    address TEXT,
+    lat REAL,
+    lng REAL,
+    source TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_gazetteer_updated_at ON gazetteer (updated_at);
+"""
+
+# A row with a new place_id or address replaces both; coordinate-only rows (from KML) keep them
+_UPSERT = """
+INSERT INTO gazetteer (key, city, name, place_id, address, lat, lng, source, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET
+    city = excluded.city,
+    name = excluded.name,
+    place_id = CASE WHEN excluded.place_id IS NULL AND excluded.address IS NULL
+                    THEN place_id ELSE excluded.place_id END,
+    address = CASE WHEN excluded.place_id IS NULL AND excluded.address IS NULL
+                   THEN address ELSE excluded.address END,
+    lat = COALESCE(excluded.lat, lat),
+    lng = COALESCE(excluded.lng, lng),
+    source = excluded.source,
+    updated_at = excluded.updated_at
+"""
+
+_COLUMNS = ('key', 'city', 'name', 'place_id', 'address', 'lat', 'lng', 'updated_at')
+
+_PLACE_ID = re.compile(r"place_id:([^&\s]+)")
+
+
+def _grams(text: str):
+    """Character bigrams of a name (the name itself when shorter)"""
+    if len(text) < 2:
+        return {text}
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _local_name(tag: str):
+    return tag.rsplit('}', 1)[-1]
+
+
+class GazetteerIndex:
+    """
+    In-memory index of usable entries (a place_id or address plus coordinates):
+    exact keys, sorted names per city for prefix matches and bigrams per city for fuzzy ones
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # city -> [(name, key)], sorted on demand
+        self._names = {}
+        self._unsorted = set()
+        # city -> {bigram: {key, ...}}
+        self._grams = {}
+
+    def add(self, entry):
+        key = entry['key']
+        known = key in self.entries
+        self.entries[key] = entry
+        if known:
+            return
+        city, name = entry['city'].casefold(), entry['name'].casefold()
+        self._names.setdefault(city, []).append((name, key))
+        self._unsorted.add(city)
+        grams = self._grams.setdefault(city, {})
+        for gram in _grams(name):
+            grams.setdefault(gram, set()).add(key)
+
+    def _cities(self, city):
+        return list(self._names) if city is None else [city.casefold()]
+
+    def prefix(self, name: str, city: str = None):
+        """Keys of entries whose name starts with name, in name order"""
+        name = name.casefold()
+        for city in self._cities(city):
+            names = self._names.get(city, [])
+            if city in self._unsorted:
+                names.sort()
+                self._unsorted.discard(city)
+            i = bisect_left(names, (name,))
+            while i < len(names) and names[i][0].startswith(name):
+                yield names[i][1]
+                i += 1
+
+    def fuzzy(self, name: str, city: str = None, limit: int = _FUZZY_CANDIDATES):
+        """[(similarity ratio, key), ...] of the closest names, best first"""
+        name = name.casefold()
+        shared = Counter()
+        for city in self._cities(city):
+            grams = self._grams.get(city, {})
+            for gram in _grams(name):
+                shared.update(grams.get(gram, ()))
+        # Candidates by bigram overlap relative to both names' lengths (Dice coefficient)
+        grams = len(_grams(name))
+        candidates = sorted(
+            shared.items(),
+            key=lambda item: -item[1] / (grams + max(len(self.entries[item[0]]['name']) - 1, 1)),
+        )
+        scored = []
+        for key, _ in candidates[:limit]:
+            ratio = difflib.SequenceMatcher(None, name, self.entries[key]['name'].casefold()).ratio()
+            scored.append((round(ratio, 4), key))
+        scored.sort(key=lambda item: -item[0])
+        return scored
+
+
+class Gazetteer:
+    """
+    Venues resolved so far (normalized city and name, Google place_id or Amap address, coordinates)
+    Stored in SQLite so every worker and run adds to it, and indexed in memory for lookups
+    """
+
+    def __init__(self, path: str, enabled: bool = True, match: str = 'exact', min_prefix: int = 4,
+                 fuzzy_ratio: float = 0.9, ttl_days: float = 30, refresh_seconds: float = 30):
+        self.path = path
+        self.enabled = enabled
+        self.match = match if match in ('exact', 'prefix', 'fuzzy') else 'exact'
+        self.min_prefix = min_prefix
+        self.fuzzy_ratio = fuzzy_ratio
+        self.ttl = ttl_days * 86400
+        self.refresh_seconds = refresh_seconds
+        self._db = LocalDB(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_until = 0.0
+        self._refreshed_at = None
+        self.counters = {'exact': 0, 'prefix': 0, 'fuzzy': 0, 'misses': 0, 'writes': 0}
+
+    def _load(self):
+        """The in-memory index, brought up to date with the SQLite file when due (call under the lock)"""
+        now = time.monotonic()
+        if self._index is not None and self._refreshed_at is not None \
+                and now - self._refreshed_at < self.refresh_seconds:
+            return self._index
+        if self._index is None:
+            self._index = GazetteerIndex()
+        try:
+            rows = self._db.connect().execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM gazetteer WHERE updated_at >= ?",
+                (self._loaded_until - _REFRESH_OVERLAP,),
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"  Gazetteer read error: {e}")
+            return self._index
+        for row in rows:
+            entry = dict(zip(_COLUMNS, row))
+            if (entry['place_id'] or entry['address']) and entry['lat'] is not None:
+                self._index.add(entry)
+            self._loaded_until = max(self._loaded_until, entry['updated_at'])
+        self._refreshed_at = now
+        return self._index
+
+    def _fresh(self, entry, now: float):
+        return self.ttl <= 0 or now - entry['updated_at'] <= self.ttl
+
+    def _match(self, index: GazetteerIndex, key: str, city: str, place: str, now: float):
+        entry = index.entries.get(key)
+        if entry is not None and self._fresh(entry, now):
+            return entry, 'exact'
+        if self.match == 'exact' or len(place) < self.min_prefix:
+            return None, 'miss'
+        matches = []
+        for match_key in index.prefix(place, city):
+            if self._fresh(index.entries[match_key], now):
+                matches.append(index.entries[match_key])
+                if len(matches) > 1:
+                    break
+        if len(matches) == 1:
+            return matches[0], 'prefix'
+        if self.match == 'fuzzy':
+            scored = [(ratio, index.entries[match_key]) for ratio, match_key in index.fuzzy(place, city)
+                      if self._fresh(index.entries[match_key], now)]
+            # Only a clear winner: two equally close names (branch 1 / branch 2) are left to the providers
+            if scored and scored[0][0] >= self.fuzzy_ratio and (len(scored) == 1 or scored[1][0] < scored[0][0]):
+                return scored[0][1], 'fuzzy'
+        return None, 'miss'
+
+    def lookup(self, keys, cities, places):
+        """
+        Known entries for a chunk of normalized rows (keys, cities and places from normalize_pairs),
+        one entry dict or None per row, matched as GAZETTEER_MATCH allows
+        """
+        if not self.enabled:
+            return [None] * len(keys)
+        now = time.time()
+        with self._lock:
+            index = self._load()
+            found = [self._match(index, key, city, place, now) for key, city, place in zip(keys, cities, places)]
+        for _, how in found:
+            GAZETTEER_LOOKUPS.inc(match=how)
+        with self._lock:
+            for _, how in found:
+                self.counters['misses' if how == 'miss' else how] += 1
+        return [entry for entry, _ in found]
+
+    def record(self, rows, source: str):
+        """
+        Add or refresh entries from (key, city, name, address, direct URL, coords) rows
+        A Google place_id is taken from the direct URL, otherwise the (Amap) address is kept
+        Rows with neither coordinates nor a place_id/address are ignored; returns the number stored
+        """
+        if not self.enabled:
+            return 0
+        now = time.time()
+        values = {}
+        for key, city, name, address, direct, coords in rows:
+            match = _PLACE_ID.search(direct or '')
+            place_id = match.group(1) if match else None
+            address = None if place_id or not direct or not address else str(address)
+            lat, lng = coords if coords is not None else (None, None)
+            if place_id is None and address is None and lat is None:
+                continue
+            values[key] = (key, city, name, place_id, address, lat, lng, source, now)
+        if not values:
+            return 0
+        try:
+            conn = self._db.connect()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(_UPSERT, list(values.values()))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"  Gazetteer write error: {e}")
+            return 0
+        with self._lock:
+            self.counters['writes'] += len(values)
+            for row in values.values():
+                entry = dict(zip(_COLUMNS, row[:7] + row[8:]))
+                if (entry['place_id'] or entry['address']) and entry['lat'] is not None:
+                    # A complete row replaces every usable field, so it can go straight into the index
+                    if self._index is not None:
+                        self._index.add(entry)
+                else:
+                    # Merged with what was stored: the next lookup reloads it
+                    self._refreshed_at = None
+        return len(values)
+
+    def import_workbook(self, path: str, source: str = 'import'):
+        """
+        Add the found rows of an output workbook; coordinates come from its hidden metadata sheet for
+        rows unchanged since it was written, or later from the matching KML file (older workbooks)
+        """
+        from utils import OUTPUT_COLUMNS, is_output_format
+
+        columns, rows, _ = open_venue_rows(path)
+        if not is_output_format(columns):
+            raise ValueError(f"{path} is not an output workbook")
+        meta = read_output_meta(path) or {}
+        stats = {'rows': 0, 'stored': 0}
+        for chunk in iter_chunks(rows):
+            chunk = [tuple(row) + (None,) * (len(OUTPUT_COLUMNS) - len(row)) for row in chunk]
+            normalized = normalize_pairs([row[0] for row in chunk], [row[1] for row in chunk])
+            records = []
+            for row, city, place, key, blank in zip(chunk, normalized['city'], normalized['place'],
+                                                    normalized['key'], normalized['blank']):
+                if blank or not row[4]:
+                    continue
+                coords = recorded_coords(meta, key, row)
+                if coords is not None and coords[0] is None:
+                    coords = None
+                records.append((key, city, place, row[2], row[4], coords))
+            stats['rows'] += len(chunk)
+            stats['stored'] += self.record(records, source)
+        return stats
+
+    def import_kml(self, path: str, source: str = 'import'):
+        """
+        Add placemark coordinates from a KML or KMZ file written by this tool
+        (placemark names are the 'city venue' queries; the first word is taken as the city);
+        merged and flagged placemarks are skipped
+        """
+        stats = {'rows': 0, 'stored': 0}
+        if path.lower().endswith('.kmz'):
+            with zipfile.ZipFile(path) as zf:
+                name = next((name for name in zf.namelist() if name.lower().endswith('.kml')), None)
+                if name is None:
+                    raise ValueError(f"{path} has no KML document")
+                with zf.open(name) as f:
+                    self._import_placemarks(f, source, stats)
+        else:
+            with open(path, 'rb') as f:
+                self._import_placemarks(f, source, stats)
+        return stats
+
+    def _import_placemarks(self, f, source: str, stats: dict):
+        def flush(placemarks):
+            cities, places = [], []
+            for name, _ in placemarks:
+                city, _, place = name.partition(' ')
+                cities.append(city if place else '')
+                places.append(place or city)
+            normalized = normalize_pairs(cities, places)
+            records = [(key, city, place, None, None, coords) for key, city, place, blank, (_, coords)
+                       in zip(normalized['key'], normalized['city'], normalized['place'], normalized['blank'],
+                              placemarks) if not blank]
+            stats['rows'] += len(placemarks)
+            stats['stored'] += self.record(records, source)
+
+        placemarks = []
+        for _, elem in ElementTree.iterparse(f):
+            if _local_name(elem.tag) != 'Placemark':
+                continue
+            name = point = None
+            summary = False
+            for child in elem.iter():
+                tag = _local_name(child.tag)
+                if tag == 'name' and name is None:
+                    name = (child.text or '').strip()
+                elif tag == 'coordinates':
+                    point = (child.text or '').strip()
+                elif tag in ('description', 'styleUrl', 'Region'):
+                    # Merged, pile-up and tile overview placemarks do not stand for one venue's point
+                    summary = True
+            elem.clear()
+            if summary:
+                continue
+            try:
+                lng, lat = (float(value) for value in point.split(',')[:2])
+            except (AttributeError, ValueError):
+                continue
+            if name:
+                placemarks.append((name, (lat, lng)))
+            if len(placemarks) >= 1000:
+                flush(placemarks)
+                placemarks = []
+        if placemarks:
+            flush(placemarks)
+
+    def import_paths(self, paths):
+        """Import every output workbook and KML/KMZ file under paths (directories are searched recursively)"""
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    files.extend(os.path.join(root, name) for name in sorted(names)
+                                 if not name.startswith('~$') and os.path.splitext(name)[1].lower() in IMPORT_EXTENSIONS)
+            elif os.path.isfile(path):
+                files.append(path)
+            else:
+                raise FileNotFoundError(f"No such file or directory: {path}")
+        totals = {'files': 0, 'rows': 0, 'stored': 0, 'errors': 0}
+        for path in files:
+            try:
+                if os.path.splitext(path)[1].lower() in ('.kml', '.kmz'):
+                    stats = self.import_kml(path)
+                else:
+                    stats = self.import_workbook(path)
+            except Exception as e:
+                print(f"Skipped {path}: {e}")
+                totals['errors'] += 1
+                continue
+            print(f"Imported {path}: {stats['stored']} of {stats['rows']} rows")
+            totals['files'] += 1
+            totals['rows'] += stats['rows']
+            totals['stored'] += stats['stored']
+        return totals
+
+    def search(self, name: str, city: str = None, limit: int = 10):
+        """[(how, score, entry), ...] for a venue name: the exact entry, prefix matches, then fuzzy ones"""
+        normalized = normalize_pairs([city], [name])
+        place = normalized['place'].iat[0]
+        city = normalized['city'].iat[0] if city else None
+        with self._lock:
+            index = self._load()
+            results = []
+            seen = set()
+            if city is not None and normalized['key'].iat[0] in index.entries:
+                results.append(('exact', 1.0, index.entries[normalized['key'].iat[0]]))
+                seen.add(normalized['key'].iat[0])
+            for key in index.prefix(place, city):
+                if len(results) >= limit:
+                    break
+                if key not in seen:
+                    results.append(('prefix', 1.0, index.entries[key]))
+                    seen.add(key)
+            for ratio, key in index.fuzzy(place, city):
+                if len(results) >= limit:
+                    break
+                if key not in seen:
+                    results.append(('fuzzy', ratio, index.entries[key]))
+                    seen.add(key)
+        return results
+
+    def stats(self):
+        """Lookup counters for this process plus the stored and usable entry counts"""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['entries'] = stats['usable'] = 0
+        if self.enabled:
+            try:
+                stats['entries'], stats['usable'] = self._db.connect().execute(
+                    "SELECT COUNT(*), COUNT(CASE WHEN (place_id IS NOT NULL OR address IS NOT NULL)"
+                    " AND lat IS NOT NULL THEN 1 END) FROM gazetteer"
+                ).fetchone()
+            except sqlite3.Error:
+                pass
+        return stats
+
+
+GAZETTEER = Gazetteer(
+    GAZETTEER_PATH,
+    enabled=GAZETTEER_ENABLED,
+    match=GAZETTEER_MATCH,
+    min_prefix=GAZETTEER_MIN_PREFIX,
+    fuzzy_ratio=GAZETTEER_FUZZY_RATIO,
+    ttl_days=GAZETTEER_TTL_DAYS,
+    refresh_seconds=GAZETTEER_REFRESH_SECONDS,
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='add output workbooks and KML/KMZ files to the gazetteer')
+    import_parser.add_argument('paths', nargs='+', help='files or directories (searched recursively)')
+    search_parser = commands.add_parser('search', help='look up a venue name')
+    search_parser.add_argument('name')
+    search_parser.add_argument('--city', help='only venues of this city')
+    search_parser.add_argument('--limit', type=int, default=10)
+    commands.add_parser('stats', help='entry counts')
+    args = parser.parse_args(argv)
+
+    gazetteer = GAZETTEER
+    if args.command == 'import':
+        totals = gazetteer.import_paths(args.paths)
+        stats = gazetteer.stats()
+        print(f"Done: {totals['stored']} entries from {totals['files']} files ({totals['errors']} skipped); "
+              f"gazetteer now has {stats['usable']} usable of {stats['entries']} entries")
+        return 1 if totals['errors'] else 0
+    if args.command == 'search':
+        for how, score, entry in gazetteer.search(args.name, args.city, args.limit):
+            target = f"place_id {entry['place_id']}" if entry['place_id'] else entry['address']
+            print(f"{how:>6} {score:.2f}  {entry['city']} {entry['name']}  ({entry['lat']}, {entry['lng']})  {target}")
+        return 0
+    stats = gazetteer.stats()
+    print(f"{stats['entries']} entries, {stats['usable']} usable (place_id or address plus coordinates)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from localdb import DATA_DIR, LocalDB
+from metrics import CACHE_LOOKUPS
+from normalize import normalize_query
+
+# ====== Cache settings ======
+CACHE_ENABLED = os.environ.get('GEOCODE_CACHE', '1') != '0'
+CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH', os.path.join(DATA_DIR, 'geocode_cache.sqlite3'))
+# Found results are kept for CACHE_TTL_DAYS, "no result" answers for CACHE_NEGATIVE_TTL_DAYS
+CACHE_TTL_DAYS = float(os.environ.get('GEOCODE_CACHE_TTL_DAYS', '30'))
+CACHE_NEGATIVE_TTL_DAYS = float(os.environ.get('GEOCODE_CACHE_NEGATIVE_TTL_DAYS', '1'))
+# Least recently used entries are evicted above this size
+CACHE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', '200000'))
+
+# Returned by get() when there is no usable entry (None is a valid cached answer)
+MISS = object()
+
+# last_used is only rewritten when older than this, to keep hits mostly read-only
+_TOUCH_INTERVAL = 300
+# Size is checked once every this many writes
+_EVICT_CHECK_EVERY = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocode_cache (
+    provider TEXT NOT NULL,
+    query TEXT NOT NULL,
+    value TEXT,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (provider, query)
+);
+CREATE INDEX IF NOT EXISTS idx_geocode_cache_last_used ON geocode_cache (last_used);
+"""
+
+
+class GeocodeCache:
+    """
+    Persistent provider response cache backed by SQLite in WAL mode
+    Safe to share between threads, gunicorn workers and restarts
+    """
+
+    def __init__(self, path: str, ttl_days: float, negative_ttl_days: float,
+                 max_entries: int, enabled: bool = True):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.negative_ttl = negative_ttl_days * 86400
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._db = LocalDB(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'writes': 0, 'evictions': 0}
+
+    def _connect(self):
+        return self._db.connect()
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def get(self, provider: str, query: str):
+        """Return the cached value for a query, or MISS"""
+        if not self.enabled:
+            return MISS
+        key = normalize_query(query)
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at, last_used FROM geocode_cache WHERE provider = ? AND query = ?",
+                (provider, key),
+            ).fetchone()
+            if row is None:
+                self._count('misses')
+                CACHE_LOOKUPS.inc(provider=provider, result='miss')
+                return MISS
+            value, created_at, last_used = row
+            now = time.time()
+            ttl = self.ttl if value != 'null' else self.negative_ttl
+            if now - created_at > ttl:
+                self._count('expired')
+                self._count('misses')
+                CACHE_LOOKUPS.inc(provider=provider, result='miss')
+                return MISS
+            if now - last_used > _TOUCH_INTERVAL:
+                conn.execute(
+                    "UPDATE geocode_cache SET last_used = ? WHERE provider = ? AND query = ?",
+                    (now, provider, key),
+                )
+            self._count('hits')
+            CACHE_LOOKUPS.inc(provider=provider, result='hit')
+            return json.loads(value)
+        except sqlite3.Error as e:
+            print(f"  Geocode cache read error: {e}")
+            self._count('misses')
+            CACHE_LOOKUPS.inc(provider=provider, result='miss')
+            return MISS
+
+    def put(self, provider: str, query: str, value):
+        """Store a provider answer; value None records a definitive "not found" """
+        if not self.enabled:
+            return
+        key = normalize_query(query)
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO geocode_cache (provider, query, value, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (provider, key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self._count('writes')
+            with self._lock:
+                self._writes += 1
+                check = self._writes % _EVICT_CHECK_EVERY == 0
+            if check:
+                self.evict()
+        except sqlite3.Error as e:
+            print(f"  Geocode cache write error: {e}")
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones above the size cap"""
+        conn = self._connect()
+        now = time.time()
+        removed = conn.execute(
+            "DELETE FROM geocode_cache WHERE (value = 'null' AND created_at < ?) OR created_at < ?",
+            (now - self.negative_ttl, now - self.ttl),
+        ).rowcount
+        total = conn.execute("SELECT COUNT(*) FROM geocode_cache").fetchone()[0]
+        if total > self.max_entries:
+            # Trim a little below the cap so eviction doesn't run on every check
+            excess = total - int(self.max_entries * 0.9)
+            removed += conn.execute(
+                "DELETE FROM geocode_cache WHERE rowid IN"
+                " (SELECT rowid FROM geocode_cache ORDER BY last_used LIMIT ?)",
+                (excess,),
+            ).rowcount
+        if removed:
+            self._count('evictions', removed)
+
+    def stats(self):
+        """Hit/miss counters for this process plus the current entry count"""
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['entries'] = 0
+        if self.enabled:
+            try:
+                stats['entries'] = self._connect().execute("SELECT COUNT(*) FROM geocode_cache").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return stats
+
+
+GEOCODE_CACHE = GeocodeCache(
+    CACHE_PATH,
+    ttl_days=CACHE_TTL_DAYS,
+    negative_ttl_days=CACHE_NEGATIVE_TTL_DAYS,
+    max_entries=CACHE_MAX_ENTRIES,
+    enabled=CACHE_ENABLED,
+)
@@ -0,0 +1,22 @@
+# Gunicorn settings, read automatically by `gunicorn app:app` from the project directory
+# Almost all request time is spent waiting on Google/Amap, so workers overlap many requests:
+#   gthread (default): each worker serves GUNICORN_THREADS requests at once with OS threads
+#   gevent:            each worker serves up to GUNICORN_WORKER_CONNECTIONS requests as
+#                      green threads (needs `pip install gevent`)
+#   sync:              one request per worker (the old setup; progress streams block workers)
+import os
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8080')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+# Workers split the provider rate limits between them (read by providers.py in each worker)
+os.environ.setdefault('PROVIDER_PROCESSES', str(workers))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# Gunicorn turns sync workers with more than one thread into gthread workers, so only gthread gets threads
+threads = int(os.environ.get('GUNICORN_THREADS', '8')) if worker_class == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '200'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+# Idle keep-alive connections (and open /events streams) count against threads/connections
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
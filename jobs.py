@@ -0,0 +1,367 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from localdb import DATA_DIR, LocalDB
+from metrics import JOBS, REGISTRY
+from storage import DOWNLOAD_TTL_HOURS, cleanup, download_path, remove_upload, start_cleaner
+from utils import process_venue_file
+
+# ====== Job queue settings ======
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', os.path.join(DATA_DIR, 'jobs.sqlite3'))
+# Background jobs run at the same time in each web worker process
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+
+# A running job with no progress for this long is reported as interrupted (worker killed/restarted)
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', '300'))
+# Queued jobs live in their worker's in-memory queue: the worker refreshes them this often (seconds),
+# so one that stops being refreshed for JOB_STALE_SECONDS was lost with its worker
+_QUEUED_HEARTBEAT_SECONDS = max(1.0, JOB_STALE_SECONDS / 5)
+
+# Progress is written to the store at most this often (seconds)
+_PROGRESS_INTERVAL = 0.5
+
+# Per-row events kept per job for the live progress stream (older ones are dropped)
+JOB_EVENT_BACKLOG = int(os.environ.get('JOB_EVENT_BACKLOG', '2000'))
+# Throughput in the progress stream is measured over this many recent seconds
+THROUGHPUT_WINDOW_SECONDS = float(os.environ.get('THROUGHPUT_WINDOW_SECONDS', '15'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    filename TEXT,
+    rows_total INTEGER,
+    rows_done INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    updated_at REAL,
+    finished_at REAL,
+    excel_filename TEXT,
+    kml_filename TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS job_timings (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (job_id, stage)
+);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    row_idx INTEGER NOT NULL,
+    venue TEXT,
+    provider TEXT,
+    seconds REAL,
+    at REAL NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+_EVENT_COLUMNS = ('seq', 'row_idx', 'venue', 'provider', 'seconds', 'at')
+
+_COLUMNS = (
+    'id', 'status', 'filename', 'rows_total', 'rows_done', 'created_at', 'started_at',
+    'updated_at', 'finished_at', 'excel_filename', 'kml_filename', 'error',
+)
+
+
+class JobStore:
+    """Job records in a local SQLite file so every gunicorn worker can answer /status"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = LocalDB(path, _SCHEMA)
+
+    def _connect(self):
+        return self._db.connect()
+
+    def create(self, job_id: str, filename: str):
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (id, status, filename, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+            (job_id, filename, now, now),
+        )
+
+    def update(self, job_id: str, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._connect().execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            (*fields.values(), job_id),
+        )
+
+    def get(self, job_id: str):
+        row = self._connect().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return dict(zip(_COLUMNS, row)) if row else None
+
+    def active_ids(self, stale_after: float):
+        """IDs of jobs that are queued or running and were updated within stale_after seconds"""
+        rows = self._connect().execute(
+            "SELECT id FROM jobs WHERE status IN ('queued', 'running') AND updated_at > ?",
+            (time.time() - stale_after,),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def touch_queued(self, job_ids):
+        """Refresh updated_at of the given jobs that are still queued"""
+        if not job_ids:
+            return
+        self._connect().execute(
+            f"UPDATE jobs SET updated_at = ? WHERE status = 'queued' AND id IN ({', '.join('?' * len(job_ids))})",
+            (time.time(), *job_ids),
+        )
+
+    def set_timings(self, job_id: str, timings: dict):
+        self._connect().executemany(
+            "INSERT OR REPLACE INTO job_timings (job_id, stage, seconds) VALUES (?, ?, ?)",
+            [(job_id, stage, seconds) for stage, seconds in timings.items()],
+        )
+
+    def get_timings(self, job_id: str):
+        rows = self._connect().execute(
+            "SELECT stage, seconds FROM job_timings WHERE job_id = ?", (job_id,)
+        ).fetchall()
+        return dict(rows)
+
+    def add_events(self, job_id: str, events):
+        """Store per-row events [(seq, row_idx, venue, provider, seconds, at), ...], keeping a backlog"""
+        if not events:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO job_events (job_id, {', '.join(_EVENT_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(job_id, *event) for event in events],
+            )
+            conn.execute(
+                "DELETE FROM job_events WHERE job_id = ? AND seq <= ?",
+                (job_id, events[-1][0] - JOB_EVENT_BACKLOG),
+            )
+
+    def events_after(self, job_id: str, seq: int, limit: int = 500):
+        rows = self._connect().execute(
+            f"SELECT {', '.join(_EVENT_COLUMNS)} FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (job_id, seq, limit),
+        ).fetchall()
+        return [dict(zip(_EVENT_COLUMNS, row)) for row in rows]
+
+    def purge_events(self, older_than: float):
+        """Drop the event backlog of jobs that finished before older_than"""
+        self._connect().execute(
+            "DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)",
+            (older_than,),
+        )
+
+
+JOB_STORE = JobStore(JOBS_DB_PATH)
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='geocode-job')
+# Jobs run in the web workers, so each worker publishes its metrics for /metrics
+REGISTRY.start_flusher()
+
+
+# Jobs waiting in this process's executor
+_queued = set()
+_queued_lock = threading.Lock()
+_heartbeat = None
+
+
+def active_job_ids():
+    return JOB_STORE.active_ids(JOB_STALE_SECONDS)
+
+
+def _start_heartbeat(interval: float = _QUEUED_HEARTBEAT_SECONDS):
+    """Keep this process's queued jobs fresh in the store (once per process)"""
+    global _heartbeat
+    if _heartbeat is not None and _heartbeat[0] == os.getpid():
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with _queued_lock:
+                job_ids = list(_queued)
+            try:
+                JOB_STORE.touch_queued(job_ids)
+            except Exception as e:
+                print(f"  Job heartbeat error: {e}")
+
+    thread = threading.Thread(target=run, name='job-heartbeat', daemon=True)
+    _heartbeat = (os.getpid(), thread)
+    thread.start()
+
+
+# Old job folders are swept in the background; folders of unfinished jobs are kept
+start_cleaner(active_job_ids)
+_start_heartbeat()
+
+
+def submit_job(job_id: str, input_path: str, output_dir: str):
+    """Queue a geocoding job; the web request returns straight away"""
+    JOB_STORE.create(job_id, os.path.basename(input_path))
+    JOB_STORE.purge_events(time.time() - 3600)
+    with _queued_lock:
+        _queued.add(job_id)
+    _executor.submit(_run_job, job_id, input_path, output_dir)
+    return job_id
+
+
+def _run_job(job_id: str, input_path: str, output_dir: str):
+    """Run process_venue_file for a queued job, recording progress and outcome"""
+    JOB_STORE.update(job_id, status='running', started_at=time.time())
+    with _queued_lock:
+        _queued.discard(job_id)
+    last_write = [0.0]
+    # Row events are buffered and written together with the throttled progress updates
+    events = []
+    events_lock = threading.Lock()
+    next_seq = [1]
+
+    def on_row(row_idx, full_name, result, source):
+        # Rows answered without a provider call are labelled by where their result came from
+        provider = result.get('provider') if source == 'lookup' else source
+        with events_lock:
+            events.append((next_seq[0], row_idx, full_name, provider, result.get('seconds'), time.time()))
+            next_seq[0] += 1
+
+    def flush_events():
+        with events_lock:
+            pending = events[:]
+            events.clear()
+        JOB_STORE.add_events(job_id, pending)
+
+    def progress(done, total):
+        now = time.monotonic()
+        if done == 0 or done == total or now - last_write[0] >= _PROGRESS_INTERVAL:
+            last_write[0] = now
+            flush_events()
+            JOB_STORE.update(job_id, rows_done=done, rows_total=total)
+
+    try:
+        result = process_venue_file(input_path, output_dir, progress=progress, on_row=on_row)
+        flush_events()
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    finally:
+        # The upload is only needed while the job runs
+        remove_upload(input_path)
+
+    JOBS.inc(status='done' if result['success'] else 'failed')
+    if result.get('timings'):
+        JOB_STORE.set_timings(job_id, result['timings'])
+    if result['success']:
+        JOB_STORE.update(
+            job_id,
+            status='done',
+            finished_at=time.time(),
+            excel_filename=result['excel_filename'],
+            kml_filename=result['kml_filename'],
+        )
+    else:
+        JOB_STORE.update(job_id, status='failed', finished_at=time.time(), error=result['error'])
+
+    # New outputs may push the download folder over its quota; this job's own files stay
+    try:
+        cleanup(active_job_ids() + [job_id])
+    except Exception as e:
+        print(f"  Storage cleanup error: {e}")
+
+
+def job_status(job_id: str):
+    """Job progress for the /status endpoint: rows done/left, ETA, outcome and stage timings"""
+    job = JOB_STORE.get(job_id)
+    if job is None:
+        return None
+
+    status = job['status']
+    error = job['error']
+    stale = time.time() - job['updated_at'] > JOB_STALE_SECONDS
+    if status == 'running' and stale:
+        status = 'interrupted'
+        error = 'Processing was interrupted. Upload the same file again to resume from the last completed row.'
+    elif status == 'queued' and stale:
+        # The worker holding the job in its queue was killed or restarted before starting it
+        status = 'interrupted'
+        error = 'The job was lost before it started (the server restarted). Upload the file again.'
+    elif status == 'done' and download_path(job_id, job['excel_filename']) is None:
+        status = 'expired'
+        error = (f'The files of this job were deleted (results are kept for {DOWNLOAD_TTL_HOURS:g} hours '
+                 f'or until storage runs low). Upload the file again to regenerate them.')
+
+    rows_total = job['rows_total']
+    rows_done = job['rows_done'] or 0
+    rows_left = rows_total - rows_done if rows_total is not None else None
+
+    end = job['finished_at'] or time.time()
+    elapsed = end - job['started_at'] if job['started_at'] else 0.0
+    eta = None
+    if status == 'running' and rows_done and rows_left is not None:
+        eta = round(elapsed / rows_done * rows_left, 1)
+    elif status == 'done':
+        eta = 0.0
+
+    return {
+        'job_id': job['id'],
+        'status': status,
+        'filename': job['filename'],
+        'rows_total': rows_total,
+        'rows_done': rows_done,
+        'rows_left': rows_left,
+        'elapsed_seconds': round(elapsed, 1),
+        'eta_seconds': eta,
+        'excel_filename': job['excel_filename'],
+        'kml_filename': job['kml_filename'],
+        'timings': JOB_STORE.get_timings(job_id) if status == 'done' else {},
+        'error': error,
+    }
+
+
+def iter_job_events(job_id: str, after_seq: int = 0, poll_seconds: float = 1.0, max_seconds: float = 300):
+    """
+    Live progress for the /events stream, as (event, data, seq) tuples
+    'row' for each resolved row after after_seq, 'progress' on every poll with counts, ETA and
+    recent throughput per provider, then 'done', 'failed', 'interrupted' or 'expired' when the job ends
+    Stops after max_seconds; the client reconnects and continues from the last seq it saw
+    """
+    deadline = time.monotonic() + max_seconds
+    recent = deque()
+    last_row_at = None
+    while True:
+        for event in JOB_STORE.events_after(job_id, after_seq):
+            after_seq = event['seq']
+            last_row_at = event['at']
+            recent.append((event['at'], event['provider'] or 'not_found'))
+            yield 'row', event, after_seq
+
+        info = job_status(job_id)
+        if info is None:
+            return
+        now = time.time()
+        while recent and recent[0][0] < now - THROUGHPUT_WINDOW_SECONDS:
+            recent.popleft()
+        span = min(THROUGHPUT_WINDOW_SECONDS, info['elapsed_seconds']) or THROUGHPUT_WINDOW_SECONDS
+        by_provider = Counter(provider for _, provider in recent)
+        yield 'progress', {
+            'status': info['status'],
+            'rows_done': info['rows_done'],
+            'rows_total': info['rows_total'],
+            'rows_left': info['rows_left'],
+            'elapsed_seconds': info['elapsed_seconds'],
+            'eta_seconds': info['eta_seconds'],
+            'rows_per_sec': round(len(recent) / span, 2),
+            'provider_rows_per_sec': {name: round(count / span, 2) for name, count in by_provider.items()},
+            'seconds_since_last_row': round(now - last_row_at, 1) if last_row_at else None,
+        }, after_seq
+
+        if info['status'] in ('done', 'failed', 'interrupted', 'expired'):
+            yield info['status'], info, after_seq
+            return
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(poll_seconds)
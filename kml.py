@@ -0,0 +1,341 @@
+import os
+import re
+import shutil
+import zipfile
+from array import array
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from spatial import cluster_points, grid_cells
+
+# 'kml' for a plain document, 'kmz' for a zipped one (smaller downloads)
+KML_FORMAT = os.environ.get('KML_FORMAT', 'kml').lower()
+# Above this many placemarks they are grouped into one folder per city (0 disables folders)
+KML_FOLDER_THRESHOLD = int(os.environ.get('KML_FOLDER_THRESHOLD', '2000'))
+# This many distinct venues on one point (within KML_PILEUP_METERS) are flagged as a likely city or
+# district centre from an approximate result and moved to a folder of their own (0 = no flagging)
+KML_PILEUP_MIN = int(os.environ.get('KML_PILEUP_MIN', '0'))
+KML_PILEUP_METERS = float(os.environ.get('KML_PILEUP_METERS', '10'))
+# Placemarks this close together are merged into one that lists all their venues (0 = keep all)
+KML_MERGE_METERS = float(os.environ.get('KML_MERGE_METERS', '0'))
+# Layout above KML_FOLDER_THRESHOLD placemarks: 'city' folders, or 'tiles' of about KML_TILE_KM
+# that Google Earth only draws when zoomed in, with one summary point per tile when zoomed out
+KML_LAYOUT = os.environ.get('KML_LAYOUT', 'city').lower()
+KML_TILE_KM = float(os.environ.get('KML_TILE_KM', '20'))
+# A tile's venues are drawn once it covers this many pixels on screen
+_TILE_LOD_PIXELS = 256
+
+# Characters that are not allowed anywhere in an XML 1.0 document
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+"""
+_FOOTER = """
+</Document>
+</kml>
+"""
+_PILEUP_STYLE = """
+    <Style id="pileup">
+        <IconStyle>
+            <color>ff00a5ff</color>
+            <Icon><href>http://maps.google.com/mapfiles/kml/shapes/caution.png</href></Icon>
+        </IconStyle>
+    </Style>"""
+
+
+def xml_text(value) -> str:
+    """Escape a value for use as XML element text"""
+    return escape(_INVALID_XML_CHARS.sub('', str(value)))
+
+
+def _placemark(name_xml: str, lat, lng, description_xml: str = None, style: str = None, region: str = ''):
+    """Placemark element from already-escaped name and description text"""
+    extra = ''
+    if description_xml:
+        extra += f"\n        <description>{description_xml}</description>"
+    if style:
+        extra += f"\n        <styleUrl>#{style}</styleUrl>"
+    return f"""
+    <Placemark>
+        <name>{name_xml}</name>{extra}{region}
+        <Point>
+            <coordinates>{lng},{lat},0</coordinates>
+        </Point>
+    </Placemark>"""
+
+
+def _region(north, south, east, west, min_pixels: int = 0, max_pixels: int = -1):
+    return f"""
+        <Region>
+            <LatLonAltBox><north>{north}</north><south>{south}</south><east>{east}</east><west>{west}</west></LatLonAltBox>
+            <Lod><minLodPixels>{min_pixels}</minLodPixels><maxLodPixels>{max_pixels}</maxLodPixels></Lod>
+        </Region>"""
+
+
+class KmlWriter:
+    """
+    Streams placemarks to a spool file on disk as rows resolve, then assembles the
+    final KML (or KMZ) document on close; large sets are split into one folder per city
+    (or into map tiles), and points shared by many venues are flagged or merged (see _plan)
+    """
+
+    def __init__(self, path: str, kmz: bool = None, folder_threshold: int = None, pileup_min: int = None,
+                 pileup_meters: float = None, merge_meters: float = None, layout: str = None,
+                 tile_km: float = None):
+        self.kmz = KML_FORMAT == 'kmz' if kmz is None else kmz
+        self.folder_threshold = KML_FOLDER_THRESHOLD if folder_threshold is None else folder_threshold
+        self.pileup_min = KML_PILEUP_MIN if pileup_min is None else pileup_min
+        self.pileup_meters = KML_PILEUP_METERS if pileup_meters is None else pileup_meters
+        self.merge_meters = KML_MERGE_METERS if merge_meters is None else merge_meters
+        self.layout = KML_LAYOUT if layout is None else layout
+        self.tile_km = KML_TILE_KM if tile_km is None else tile_km
+        self.path = path
+        self._spool_path = path + '.part'
+        self._spool = open(self._spool_path, 'w+b')
+        # Per placemark, in order: spool span, point and city id (compact arrays for large files)
+        self._offsets = array('q')
+        self._lengths = array('l')
+        self._lats = array('d')
+        self._lngs = array('d')
+        self._cities = array('l')
+        self._city_ids = {}
+        self.count = 0
+        # Set on close: placemarks written, placemarks merged away, flagged pile-ups and their venues
+        self.summary = {}
+
+    def add(self, lat, lng, name, city=None):
+        placemark = _placemark(xml_text(name), lat, lng).encode('utf-8')
+        offset = self._spool.tell()
+        self._spool.write(placemark)
+        city = str(city).strip() if city is not None and str(city).strip() else 'Unknown'
+        self._offsets.append(offset)
+        self._lengths.append(len(placemark))
+        self._lats.append(float(lat))
+        self._lngs.append(float(lng))
+        self._cities.append(self._city_ids.setdefault(city, len(self._city_ids)))
+        self.count += 1
+
+    def _read(self, i):
+        self._spool.seek(self._offsets[i])
+        return self._spool.read(self._lengths[i])
+
+    def _name(self, i):
+        """Escaped name of placemark i, as spooled"""
+        placemark = self._read(i).decode('utf-8')
+        return placemark[placemark.index('<name>') + len('<name>'):placemark.index('</name>')]
+
+    def _plan(self):
+        """
+        Spatial post-processing of the spooled points, or None when the plain layout applies
+        Points are grouped with a grid index (spatial.cluster_points), each group holding the points
+        within a radius of its first one: groups of at least pileup_min distinct venues within
+        pileup_meters are pile-ups, and with merge_meters set, every group within merge_meters
+        becomes one placemark
+        Returns [(indices in spool order, is pile-up), ...] in order of each group's first placemark
+        """
+        tiles = self.layout == 'tiles' and 0 < self.folder_threshold < self.count
+        if not self.count or (self.pileup_min <= 0 and self.merge_meters <= 0 and not tiles):
+            return None
+        lats = np.frombuffer(self._lats, dtype=float)
+        lngs = np.frombuffer(self._lngs, dtype=float)
+
+        pileup_labels = set()
+        if self.pileup_min > 0:
+            pileup_of = cluster_points(lats, lngs, self.pileup_meters)
+            for label, members in _members(pileup_of, self.pileup_min):
+                # Repeated rows of one venue are not a pile-up
+                if len({self._name(i) for i in members}) >= self.pileup_min:
+                    pileup_labels.add(label)
+        if not pileup_labels and self.merge_meters <= 0 and not tiles:
+            return None
+
+        merge_of = cluster_points(lats, lngs, self.merge_meters) if self.merge_meters > 0 else None
+        groups = {}
+        for i in range(self.count):
+            if pileup_labels and int(pileup_of[i]) in pileup_labels:
+                # A pile-up is kept apart from the points around it
+                key = ('pileup', int(pileup_of[i]))
+            elif merge_of is not None:
+                key = ('merge', int(merge_of[i]))
+            else:
+                key = ('point', i)
+            groups.setdefault(key, []).append(i)
+        return [(members, kind == 'pileup') for (kind, _), members in groups.items()]
+
+    def _group_placemark(self, members, pileup: bool = False, region: str = ''):
+        """Placemark bytes for a group: the spooled one, or a merged or flagged one"""
+        if len(members) == 1 and not pileup and not region:
+            return self._read(members[0])
+        names = list(dict.fromkeys(self._name(i) for i in members))
+        if pileup:
+            description = (f"{len(names)} venues share this point, probably an approximate city or district "
+                           f"centre: check their locations")
+        elif len(members) > 1:
+            description = f"{len(names)} venues within {self.merge_meters:g} m of {names[0]}"
+        else:
+            description = None
+        if len(members) == 1:
+            i = members[0]
+            return _placemark(names[0], self._lats[i], self._lngs[i], description,
+                              'pileup' if pileup else None, region).encode('utf-8')
+        name = names[0] if len(names) == 1 else f"{names[0]} (+{len(names) - 1} more)"
+        description += ':&lt;br&gt;' + '&lt;br&gt;'.join(names)
+        lat = round(sum(self._lats[i] for i in members) / len(members), 7)
+        lng = round(sum(self._lngs[i] for i in members) / len(members), 7)
+        return _placemark(name, lat, lng, description, 'pileup' if pileup else None, region).encode('utf-8')
+
+    def _write_pileups(self, out, pileups):
+        venues = sum(len(members) for members in pileups)
+        out.write(f"\n    <Folder>\n        <name>Possible approximate locations: {venues} venues at "
+                  f"{len(pileups)} points</name>".encode('utf-8'))
+        for members in pileups:
+            if self.merge_meters > 0:
+                out.write(self._group_placemark(members, pileup=True))
+                continue
+            lat, lng = self._lats[members[0]], self._lngs[members[0]]
+            out.write(f"\n    <Folder>\n        <name>{len(members)} venues at {lat}, {lng}</name>".encode('utf-8'))
+            for i in members:
+                out.write(self._group_placemark([i], pileup=True))
+            out.write(b"\n    </Folder>")
+        out.write(b"\n    </Folder>")
+
+    def _write_tiles(self, out, groups):
+        """
+        One folder per map tile that Google Earth only draws once the tile is large on screen,
+        plus an overview point per tile (its venue count) shown while zoomed out
+        """
+        lats = np.array([self._lats[members[0]] for members, _ in groups])
+        lngs = np.array([self._lngs[members[0]] for members, _ in groups])
+        rows, cols, dlat, dlng = grid_cells(lats, lngs, self.tile_km * 1000)
+        tiles = {}
+        for index, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            tiles.setdefault(cell, []).append(index)
+
+        def box(row, col, min_pixels, max_pixels):
+            return _region(round((row + 1) * dlat, 7), round(row * dlat, 7), round((col + 1) * dlng, 7),
+                           round(col * dlng, 7), min_pixels, max_pixels)
+
+        out.write(b"\n    <Folder>\n        <name>Overview</name>")
+        for (row, col), indices in tiles.items():
+            venues = sum(len(groups[index][0]) for index in indices)
+            lat = round(float(lats[indices].mean()), 7)
+            lng = round(float(lngs[indices].mean()), 7)
+            region = box(row, col, 0, _TILE_LOD_PIXELS)
+            out.write(_placemark(f"{venues} venues", lat, lng, region=region).encode('utf-8'))
+        out.write(b"\n    </Folder>")
+        for (row, col), indices in tiles.items():
+            venues = sum(len(groups[index][0]) for index in indices)
+            lat = round(float(lats[indices].mean()), 3)
+            lng = round(float(lngs[indices].mean()), 3)
+            out.write(f"\n    <Folder>\n        <name>{venues} venues near {lat}, {lng}</name>"
+                      f"{box(row, col, _TILE_LOD_PIXELS, -1)}".encode('utf-8'))
+            for index in indices:
+                out.write(self._group_placemark(*groups[index]))
+            out.write(b"\n    </Folder>")
+
+    def _write_planned(self, out, plan):
+        out.write(_HEADER.encode('utf-8'))
+        pileups = [members for members, pileup in plan if pileup]
+        rest = [(members, False) for members, pileup in plan if not pileup]
+        if pileups:
+            out.write(_PILEUP_STYLE.encode('utf-8'))
+            self._write_pileups(out, pileups)
+        if self.layout == 'tiles' and 0 < self.folder_threshold < len(rest):
+            self._write_tiles(out, rest)
+        elif 0 < self.folder_threshold < len(rest) and len({self._cities[members[0]] for members, _ in rest}) > 1:
+            city_names = {city_id: city for city, city_id in self._city_ids.items()}
+            by_city = {}
+            for group in rest:
+                by_city.setdefault(self._cities[group[0][0]], []).append(group)
+            for city_id, city_groups in by_city.items():
+                out.write(f"\n    <Folder>\n        <name>{xml_text(city_names[city_id])}</name>".encode('utf-8'))
+                for group in city_groups:
+                    out.write(self._group_placemark(*group))
+                out.write(b"\n    </Folder>")
+        else:
+            for group in rest:
+                out.write(self._group_placemark(*group))
+        out.write(_FOOTER.encode('utf-8'))
+
+        written = len(rest) + (len(pileups) if self.merge_meters > 0 else sum(len(members) for members in pileups))
+        self.summary.update({
+            'placemarks': written,
+            'merged': self.count - written,
+            'pileups': len(pileups),
+            'pileup_venues': sum(len(members) for members in pileups),
+        })
+
+    def _write_document(self, out):
+        out.write(_HEADER.encode('utf-8'))
+        use_folders = 0 < self.folder_threshold < self.count and len(self._city_ids) > 1
+        if use_folders:
+            cities = np.frombuffer(self._cities, dtype=self._cities.typecode)
+            # Placemarks of each city in spool order, cities in order of first appearance
+            order = np.argsort(cities, kind='stable')
+            bounds = np.searchsorted(cities[order], np.arange(len(self._city_ids) + 1))
+            for city, city_id in self._city_ids.items():
+                out.write(f"\n    <Folder>\n        <name>{xml_text(city)}</name>".encode('utf-8'))
+                for i in order[bounds[city_id]:bounds[city_id + 1]].tolist():
+                    out.write(self._read(i))
+                out.write(b"\n    </Folder>")
+        else:
+            self._spool.seek(0)
+            shutil.copyfileobj(self._spool, out)
+        out.write(_FOOTER.encode('utf-8'))
+
+    def close(self):
+        self._spool.flush()
+        self.summary = {'placemarks': self.count, 'merged': 0, 'pileups': 0, 'pileup_venues': 0}
+        try:
+            plan = self._plan()
+
+            def write(out):
+                if plan is None:
+                    self._write_document(out)
+                else:
+                    self._write_planned(out, plan)
+
+            if self.kmz:
+                with zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                    with zf.open('doc.kml', 'w') as out:
+                        write(out)
+            else:
+                with open(self.path, 'wb') as out:
+                    write(out)
+        finally:
+            self._spool.close()
+            os.remove(self._spool_path)
+
+    def abort(self):
+        """Discard the spool without writing a document"""
+        self._spool.close()
+        try:
+            os.remove(self._spool_path)
+        except OSError:
+            pass
+
+
+def summary_lines(summary: dict):
+    """Log lines for a closed writer's spatial post-processing (none when nothing was changed)"""
+    lines = []
+    if summary.get('pileups'):
+        lines.append(f"KML: {summary['pileup_venues']} venues at {summary['pileups']} shared points "
+                     f"flagged as likely approximate locations")
+    if summary.get('merged'):
+        lines.append(f"KML: {summary['merged']} nearby placemarks merged, {summary['placemarks']} written")
+    return lines
+
+
+def _members(labels, min_size: int):
+    """(label, [indices]) for every label shared by at least min_size points"""
+    sizes = np.bincount(labels, minlength=len(labels))
+    large = np.flatnonzero(sizes >= min_size)
+    if not len(large):
+        return []
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.searchsorted(sorted_labels, large, side='left')
+    return [(int(label), order[start:start + sizes[label]].tolist()) for label, start in zip(large, starts)]
@@ -0,0 +1,366 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from localdb import DATA_DIR, LocalDB
+
+# ====== Metrics settings ======
+METRICS_DB_PATH = os.environ.get('METRICS_DB_PATH', os.path.join(DATA_DIR, 'metrics.sqlite3'))
+# Each web worker publishes its counters this often so /metrics can add up all workers
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+
+# Default latency buckets (seconds) for provider requests
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Buckets for whole-job stage durations (seconds)
+STAGE_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics_snapshots (
+    process TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(key): value for key, value in self._values.items()}
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def render(self, values):
+        lines = []
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, json.loads(key))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, plus their sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(key): [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return [list(value[0]), value[1], value[2]]
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1], total[2] + value[2]]
+
+    def render(self, values):
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            label_values = json.loads(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, label_values, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, label_values, [('le', '+Inf')])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """A value computed at scrape time from the merged metrics of all workers"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms for this process, rendered in the Prometheus text format
+    Every web worker writes its snapshot to a shared SQLite file so one scrape covers all workers
+    """
+
+    def __init__(self, db_path: str):
+        self._metrics = {}
+        self._db = LocalDB(db_path, _SCHEMA)
+        self._process = f"{socket.gethostname()}:{os.getpid()}"
+        self._flusher = None
+
+    def counter(self, name: str, help: str, labelnames=()):
+        return self._metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, fn):
+        """fn(values) gets the merged values of all metrics and returns the gauge value"""
+        return self._metrics.setdefault(name, Gauge(name, help, fn))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items() if metric.kind != 'gauge'}
+
+    def flush(self):
+        """Publish this process's snapshot for the other workers' /metrics"""
+        now = time.time()
+        try:
+            conn = self._db.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics_snapshots (process, data, updated_at) VALUES (?, ?, ?)",
+                (self._process, json.dumps(self.snapshot()), now),
+            )
+            # Workers that stopped publishing have exited; their counts drop out like a restart
+            conn.execute("DELETE FROM metrics_snapshots WHERE updated_at < ?", (now - 3600,))
+        except sqlite3.Error as e:
+            print(f"  Metrics flush error: {e}")
+
+    def start_flusher(self, interval: float = METRICS_FLUSH_SECONDS):
+        """Flush in a background thread (once per process)"""
+        if self._flusher is not None and self._flusher[0] == os.getpid():
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        thread = threading.Thread(target=run, name='metrics-flush', daemon=True)
+        self._flusher = (os.getpid(), thread)
+        # The process key is taken again in case this process was forked after import
+        self._process = f"{socket.gethostname()}:{os.getpid()}"
+        thread.start()
+
+    def collect(self):
+        """Merged values of every metric across this process and the live workers"""
+        snapshots = [self.snapshot()]
+        if self._flusher is not None:
+            stale_after = max(30.0, METRICS_FLUSH_SECONDS * 3)
+            try:
+                rows = self._db.connect().execute(
+                    "SELECT data FROM metrics_snapshots WHERE process != ? AND updated_at > ?",
+                    (self._process, time.time() - stale_after),
+                ).fetchall()
+                snapshots.extend(json.loads(data) for data, in rows)
+            except sqlite3.Error as e:
+                print(f"  Metrics read error: {e}")
+
+        merged = {}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                target = merged.setdefault(name, {})
+                for key, value in values.items():
+                    target[key] = metric.merge(target.get(key), value)
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        merged = self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == 'gauge':
+                lines.append(f"{name} {_format_value(metric.fn(merged))}")
+            else:
+                lines.extend(metric.render(merged.get(name, {})))
+        return "\n".join(lines) + "\n"
+
+
+class StageTimings:
+    """
+    Wall-clock seconds spent in each stage of one run
+    Stages can nest; time spent in an inner stage is not counted again in the outer one
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self._stack = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        frame = [name, time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - frame[2]
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def wrap(self, name: str, iterable):
+        """Yield from iterable, counting the time spent producing each item as stage name"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        summary = {name: round(seconds, 3) for name, seconds in self.seconds.items()}
+        summary['total'] = round(time.perf_counter() - self._start, 3)
+        return summary
+
+
+REGISTRY = MetricsRegistry(METRICS_DB_PATH)
+
+PROVIDER_REQUEST_SECONDS = REGISTRY.histogram(
+    'geocoder_provider_request_seconds',
+    'Latency of each HTTP request to a geocoding provider',
+    ('provider',),
+)
+PROVIDER_WAIT_SECONDS = REGISTRY.histogram(
+    'geocoder_provider_wait_seconds',
+    'Time a request waited for its provider concurrency slot and rate limit',
+    ('provider',),
+)
+PROVIDER_REQUESTS = REGISTRY.counter(
+    'geocoder_provider_requests_total',
+    'HTTP requests to geocoding providers by outcome (ok, transient, rate_limited, quota_exhausted, network_error)',
+    ('provider', 'outcome'),
+)
+PROVIDER_SKIPPED = REGISTRY.counter(
+    'geocoder_provider_skipped_total',
+    'Lookups that got no answer because the provider\'s daily quota is exhausted',
+    ('provider',),
+)
+GOOGLE_LOCATION_TYPES = REGISTRY.counter(
+    'geocoder_google_location_types_total',
+    'Google precision for each venue query (none when Google found nothing)',
+    ('location_type',),
+)
+VENUE_OUTCOMES = REGISTRY.counter(
+    'geocoder_venue_outcomes_total',
+    'How each unique venue query was resolved (google, amap_fallback, not_found)',
+    ('outcome',),
+)
+HEDGES = REGISTRY.counter(
+    'geocoder_hedges_total',
+    'Amap searches started alongside Google (hedged) and whether they were used, wasted or cancelled',
+    ('result',),
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    'geocoder_cache_lookups_total',
+    'Geocode cache lookups by provider and result (hit, miss)',
+    ('provider', 'result'),
+)
+GAZETTEER_LOOKUPS = REGISTRY.counter(
+    'geocoder_gazetteer_lookups_total',
+    'Rows looked up in the local gazetteer by how they matched (exact, prefix, fuzzy, miss)',
+    ('match',),
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    'geocoder_job_stage_seconds',
+    'Time each processed file spent per stage (read, resolve, excel, kml, total)',
+    ('stage',),
+    buckets=STAGE_BUCKETS,
+)
+ROWS_PROCESSED = REGISTRY.counter(
+    'geocoder_rows_processed_total',
+    'Rows written to output files or streamed from the JSON API',
+)
+JOBS = REGISTRY.counter(
+    'geocoder_jobs_total',
+    'Finished background jobs by status (done, failed)',
+    ('status',),
+)
+
+
+def _cache_hit_ratio(values):
+    hits = misses = 0
+    for key, value in values.get(CACHE_LOOKUPS.name, {}).items():
+        if json.loads(key)[1] == 'hit':
+            hits += value
+        else:
+            misses += value
+    return round(hits / (hits + misses), 4) if hits + misses else 0.0
+
+
+REGISTRY.gauge(
+    'geocoder_cache_hit_ratio',
+    'Share of geocode cache lookups answered from the cache',
+    _cache_hit_ratio,
+)
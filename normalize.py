@@ -0,0 +1,62 @@
+import re
+import unicodedata
+
+import pandas as pd
+
+_WHITESPACE = re.compile(r"\s+")
+# Chinese names are written without spaces, so a space between two CJK characters is noise (先锋 书店)
+_CJK_GAP = r"(?<=[\u3400-\u9fff]) (?=[\u3400-\u9fff])"
+
+# Administrative suffixes dropped from city names, so 南京市/南京 and 香港特别行政区/香港 match;
+# at least two characters must remain. Generic 区 is kept: 浦东新区 is not 浦东新
+# English "City" is part of many names (Kansas City, Mexico City), so it is never dropped
+_CITY_SUFFIX = r"(?<=\w\w)(?:特别行政区|地区|市)$"
+# Cell text that means "no value" (pandas writes missing values as nan when exporting CSV)
+_BLANK_TOKENS = ['nan', 'none', 'null', 'n/a', '#n/a']
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form of a lookup query: full-width folded, whitespace collapsed, case-folded"""
+    text = unicodedata.normalize("NFKC", str(text))
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text.casefold()
+
+
+def clean_cells(values) -> pd.Series:
+    """
+    Cell values as text: full-width folded (NFKC), whitespace collapsed and stripped, spaces
+    between CJK characters dropped
+    None, NaN and placeholder text such as 'nan' become ''
+    """
+    text = pd.Series(values, dtype=object)
+    text = text.where(text.notna(), None).astype('string')
+    text = text.str.normalize('NFKC').str.replace(_WHITESPACE.pattern, ' ', regex=True).str.strip()
+    text = text.str.replace(_CJK_GAP, '', regex=True)
+    text = text.mask(text.str.casefold().isin(_BLANK_TOKENS), '')
+    return text.fillna('').astype(object)
+
+
+def canonical_city(cities: pd.Series) -> pd.Series:
+    """Cleaned city names without Chinese administrative suffixes (南京市 -> 南京)"""
+    cities = pd.Series(cities, dtype=object).astype('string')
+    cities = cities.str.replace(_CITY_SUFFIX, '', regex=True)
+    return cities.fillna('').astype(object)
+
+
+def normalize_pairs(cities, places) -> pd.DataFrame:
+    """
+    Vectorized normalization of a chunk of (city, place) cells, one row per input row
+    Columns: 'query' (text sent to the providers), 'key' (canonical dedup/cache key,
+    equal to normalize_query(query)), 'blank' (no venue name: the row is not looked up)
+    and the cleaned 'city' and 'place' the query is made of
+    """
+    city = canonical_city(clean_cells(cities))
+    place = clean_cells(places)
+    query = (city + ' ' + place).str.strip()
+    return pd.DataFrame({
+        'city': city,
+        'place': place,
+        'query': query,
+        'key': query.str.casefold(),
+        'blank': place == '',
+    })
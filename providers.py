@@ -0,0 +1,196 @@
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import PROVIDER_REQUEST_SECONDS, PROVIDER_REQUESTS, PROVIDER_WAIT_SECONDS
+from throttle import ProviderLimiter, ProviderUnavailable
+
+# ====== HTTP client settings ======
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+# Retries after the first attempt for transient failures
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+# Backoff before retry n is a random delay in [0, min(BACKOFF_MAX, BACKOFF_BASE * 2**n)]
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', '0.5'))
+HTTP_BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', '8'))
+
+# Endpoints can be pointed at a local stand-in server (see bench/mock_providers.py)
+GOOGLE_GEOCODE_URL = os.environ.get('GOOGLE_GEOCODE_URL', "https://maps.googleapis.com/maps/api/geocode/json")
+AMAP_PLACE_URL = os.environ.get('AMAP_PLACE_URL', "https://restapi.amap.com/v3/place/text")
+
+# Processes sharing the rate limits and concurrency caps below (gunicorn.conf.py sets it to
+# WEB_CONCURRENCY); each process keeps to its share, so the configured values hold server-wide
+PROVIDER_PROCESSES = max(1, int(os.environ.get('PROVIDER_PROCESSES', '1')))
+
+# Optional daily request budgets (0 = no local budget; the provider's own limit still trips the circuit)
+GOOGLE_DAILY_QUOTA = int(os.environ.get('GOOGLE_DAILY_QUOTA', '0'))
+AMAP_DAILY_QUOTA = int(os.environ.get('AMAP_DAILY_QUOTA', '0'))
+
+# Google statuses worth retrying (everything else is a final answer)
+GOOGLE_TRANSIENT_STATUSES = {'OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'}
+GOOGLE_RATE_LIMIT_STATUSES = {'OVER_QUERY_LIMIT'}
+GOOGLE_QUOTA_STATUSES = {'OVER_DAILY_LIMIT'}
+# Amap "info" values for per-second rate limits and server-side hiccups
+AMAP_RATE_LIMIT_INFOS = {
+    'ACCESS_TOO_FREQUENT',
+    'CUQPS_HAS_EXCEEDED_THE_LIMIT',
+    'CKQPS_HAS_EXCEEDED_THE_LIMIT',
+    'CQPS_HAS_EXCEEDED_THE_LIMIT',
+    'QPS_HAS_EXCEEDED_THE_LIMIT',
+}
+AMAP_TRANSIENT_INFOS = AMAP_RATE_LIMIT_INFOS | {
+    'SERVICE_NOT_AVAILABLE',
+    'ENGINE_RESPONSE_DATA_ERROR',
+    'UNKNOWN_ERROR',
+}
+# Amap "info" values meaning the key's daily quota is used up
+AMAP_QUOTA_INFOS = {
+    'DAILY_QUERY_OVER_LIMIT',
+    'USER_DAILY_QUERY_OVER_LIMIT',
+    'USER_ABROAD_DAILY_QUERY_OVER_LIMIT',
+}
+
+
+class TransientProviderError(Exception):
+    """A provider answer that should be retried (5xx, 429, rate-limit status)"""
+
+    def __init__(self, message: str, kind: str = 'transient'):
+        super().__init__(message)
+        self.kind = kind
+
+
+class ProviderClient:
+    """
+    Shared HTTP client for one provider
+    Keeps a pool of keep-alive connections and retries transient failures with jittered backoff
+    """
+
+    def __init__(self, name: str, url: str, limiter: ProviderLimiter, classify=None):
+        self.name = name
+        self.url = url
+        self.limiter = limiter
+        # classify(data) -> 'rate_limited', 'transient', 'quota_exhausted' or None for a final answer
+        self.classify = classify
+        self.timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self.max_retries = HTTP_MAX_RETRIES
+        self.session = requests.Session()
+        # One pool per host, sized to the provider's concurrency cap
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=limiter.max_concurrency + 2, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _backoff(self, attempt: int):
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+    def get_json(self, params: dict):
+        """
+        GET the provider URL and return the decoded JSON body, retrying transient failures
+        Raises ProviderUnavailable without calling out once the provider's daily quota is exhausted
+        """
+        attempt = 0
+        while True:
+            try:
+                waited = time.perf_counter()
+                with self.limiter:
+                    started = time.perf_counter()
+                    PROVIDER_WAIT_SECONDS.observe(started - waited, provider=self.name)
+                    try:
+                        r = self.session.get(self.url, params=params, timeout=self.timeout)
+                    finally:
+                        PROVIDER_REQUEST_SECONDS.observe(time.perf_counter() - started, provider=self.name)
+                if r.status_code == 429:
+                    self.limiter.rate_limited()
+                    raise TransientProviderError(f"HTTP {r.status_code}", 'rate_limited')
+                if r.status_code >= 500:
+                    raise TransientProviderError(f"HTTP {r.status_code}")
+                r.encoding = 'utf-8'
+                data = r.json()
+                kind = self.classify(data) if self.classify is not None else None
+                if kind == 'quota_exhausted':
+                    PROVIDER_REQUESTS.inc(provider=self.name, outcome=kind)
+                    reason = data.get('info') or data.get('status')
+                    self.limiter.quota_exhausted(reason)
+                    raise ProviderUnavailable(f"{self.name} quota exhausted: {reason}")
+                if kind is not None:
+                    if kind == 'rate_limited':
+                        self.limiter.rate_limited()
+                    raise TransientProviderError(f"status={data.get('status')}, info={data.get('info')}", kind)
+                PROVIDER_REQUESTS.inc(provider=self.name, outcome='ok')
+                self.limiter.succeeded()
+                return data
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, TransientProviderError) as e:
+                outcome = e.kind if isinstance(e, TransientProviderError) else 'network_error'
+                PROVIDER_REQUESTS.inc(provider=self.name, outcome=outcome)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                attempt += 1
+                print(f"  {self.name} transient error ({e}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                time.sleep(delay)
+
+
+def _classify_google(data):
+    status = data.get("status")
+    if status in GOOGLE_QUOTA_STATUSES:
+        return 'quota_exhausted'
+    if status in GOOGLE_RATE_LIMIT_STATUSES:
+        return 'rate_limited'
+    if status in GOOGLE_TRANSIENT_STATUSES:
+        return 'transient'
+    return None
+
+
+def _classify_amap(data):
+    if data.get("status") == "1":
+        return None
+    info = data.get("info")
+    if info in AMAP_QUOTA_INFOS:
+        return 'quota_exhausted'
+    if info in AMAP_RATE_LIMIT_INFOS:
+        return 'rate_limited'
+    if info in AMAP_TRANSIENT_INFOS:
+        return 'transient'
+    return None
+
+
+def _share_rate(name: str, default: str) -> float:
+    return float(os.environ.get(name, default)) / PROVIDER_PROCESSES
+
+
+def _share_concurrency(name: str, default: str) -> int:
+    # Rounded down so the processes together never exceed the cap, but every process can make calls
+    return max(1, int(os.environ.get(name, default)) // PROVIDER_PROCESSES)
+
+
+GOOGLE_CLIENT = ProviderClient(
+    'google',
+    GOOGLE_GEOCODE_URL,
+    ProviderLimiter(
+        'google',
+        max_concurrency=_share_concurrency('GOOGLE_MAX_CONCURRENCY', '10'),
+        rate_per_sec=_share_rate('GOOGLE_RPS', '40'),
+        burst=int(os.environ.get('GOOGLE_BURST', '1')),
+        daily_limit=GOOGLE_DAILY_QUOTA,
+        # Google's daily quotas reset at midnight Pacific Time
+        reset_utc_offset=float(os.environ.get('GOOGLE_QUOTA_RESET_UTC_OFFSET', '-8')),
+    ),
+    classify=_classify_google,
+)
+AMAP_CLIENT = ProviderClient(
+    'amap',
+    AMAP_PLACE_URL,
+    ProviderLimiter(
+        'amap',
+        max_concurrency=_share_concurrency('AMAP_MAX_CONCURRENCY', '3'),
+        rate_per_sec=_share_rate('AMAP_RPS', '3'),
+        burst=int(os.environ.get('AMAP_BURST', '1')),
+        daily_limit=AMAP_DAILY_QUOTA,
+        # Amap's daily quotas reset at midnight Beijing time
+        reset_utc_offset=float(os.environ.get('AMAP_QUOTA_RESET_UTC_OFFSET', '8')),
+    ),
+    classify=_classify_amap,
+)
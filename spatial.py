@@ -0,0 +1,99 @@
+import numpy as np
+
+from coordtransform import haversine_m
+
+# Metres per degree of latitude (and of longitude at the equator)
+_METRES_PER_DEGREE = 111_320.0
+# Grid cell keys pack (row, column) into one int64
+_COLUMN_SPAN = 1 << 32
+
+
+def grid_cells(lats, lngs, cell_m: float):
+    """
+    Grid cell (row, column) of each point for cells about cell_m metres on a side
+    Columns are sized at the highest latitude present, so no cell is narrower than cell_m
+    Returns (rows, columns, cell height in degrees, cell width in degrees)
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    max_lat = min(float(np.abs(lats).max()), 89.0) if len(lats) else 0.0
+    dlat = cell_m / _METRES_PER_DEGREE
+    dlng = cell_m / (_METRES_PER_DEGREE * np.cos(np.radians(max_lat)))
+    return np.floor(lats / dlat).astype(np.int64), np.floor(lngs / dlng).astype(np.int64), dlat, dlng
+
+
+def _expand(lo, hi):
+    """For ranges [lo, hi) per item: (item index, position) for every position of every range"""
+    counts = hi - lo
+    owners = np.repeat(np.arange(len(lo)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(lo, counts) + np.arange(counts.sum()) - starts
+
+
+def neighbour_pairs(lats, lngs, radius_m: float):
+    """
+    (i, j) index arrays of every pair of points at most radius_m apart, with i < j
+    Points are bucketed in a grid of radius_m cells, sorted by cell; each point is only compared
+    with the points of the 3x3 block of cells around its own, found by binary search
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    if len(lats) < 2 or radius_m <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, cols, _, _ = grid_cells(lats, lngs, radius_m)
+    keys = rows * _COLUMN_SPAN + cols
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    firsts, seconds = [], []
+    for d_row in (-1, 0, 1):
+        for d_col in (-1, 0, 1):
+            wanted = keys + d_row * _COLUMN_SPAN + d_col
+            lo = np.searchsorted(sorted_keys, wanted, side='left')
+            hi = np.searchsorted(sorted_keys, wanted, side='right')
+            i, positions = _expand(lo, hi)
+            j = order[positions]
+            keep = i < j
+            i, j = i[keep], j[keep]
+            close = haversine_m(lats[i], lngs[i], lats[j], lngs[j]) <= radius_m
+            firsts.append(i[close])
+            seconds.append(j[close])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def cluster_points(lats, lngs, radius_m: float):
+    """
+    Group label per point (the lowest index of its group) such that every point is at most
+    radius_m from its group's first point, so no group spans more than twice radius_m
+    Points are taken in order: each one not yet grouped starts a group and takes every ungrouped
+    point within radius_m of it; identical coordinates are always grouped
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    if not len(lats):
+        return np.zeros(0, dtype=np.int64)
+    # Pile-ups are mostly exact repeats of one point: compare each distinct point only once
+    points, first, inverse = np.unique(np.stack([lats, lngs], axis=1), axis=0, return_index=True,
+                                       return_inverse=True)
+    inverse = inverse.reshape(-1)
+    firsts, seconds = neighbour_pairs(points[:, 0], points[:, 1], radius_m)
+    # Neighbours of distinct point p are ends[bounds[p]:bounds[p + 1]]
+    begins = np.concatenate([firsts, seconds])
+    ends = np.concatenate([seconds, firsts])
+    order = np.argsort(begins, kind='stable')
+    begins, ends = begins[order], ends[order]
+    bounds = np.searchsorted(begins, np.arange(len(points) + 1))
+
+    seeds = np.arange(len(points))
+    grouped = bounds[1:] == bounds[:-1]
+    # Seeds in input order; isolated points are their own seed
+    for point in np.argsort(first, kind='stable'):
+        if grouped[point]:
+            continue
+        grouped[point] = True
+        neighbours = ends[bounds[point]:bounds[point + 1]]
+        neighbours = neighbours[~grouped[neighbours]]
+        seeds[neighbours] = point
+        grouped[neighbours] = True
+    # Back to input order, labelled by the seed's first input index (the lowest in its group)
+    return first[seeds][inverse]
@@ -0,0 +1,151 @@
+import os
+import shutil
+import threading
+import time
+
+from werkzeug.security import safe_join
+
+# ====== Download storage settings ======
+# One folder per job holds its upload (while the job runs) and its output files
+DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads'))
+# Job folders are deleted this many hours after they were last written (0 = keep forever)
+DOWNLOAD_TTL_HOURS = float(os.environ.get('DOWNLOAD_TTL_HOURS', '24'))
+# Total size cap for all job folders; the oldest are evicted first when it is exceeded (0 = no cap)
+DOWNLOAD_QUOTA_MB = float(os.environ.get('DOWNLOAD_QUOTA_MB', '2048'))
+# How often each web worker sweeps the download folder
+STORAGE_CLEANUP_SECONDS = float(os.environ.get('STORAGE_CLEANUP_SECONDS', '600'))
+
+# Uploads are kept apart from the outputs, which may have the same name (venues_output.xlsx)
+UPLOAD_SUBDIR = 'upload'
+
+_cleaner = None
+_cleanup_lock = threading.Lock()
+
+
+def job_dir(job_id: str):
+    """Folder of one job (created if missing)"""
+    path = safe_join(DOWNLOAD_FOLDER, job_id)
+    if path is None:
+        raise ValueError(f"Invalid job id: {job_id}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def upload_path(job_id: str, filename: str):
+    """Where a job's uploaded file is saved; it is deleted when the job finishes"""
+    folder = os.path.join(job_dir(job_id), UPLOAD_SUBDIR)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, filename)
+
+
+def remove_upload(input_path: str):
+    """Delete a job's upload once the job is finished, with its folder if that is now empty"""
+    try:
+        os.remove(input_path)
+    except OSError:
+        pass
+    folder = os.path.dirname(input_path)
+    if os.path.basename(folder) == UPLOAD_SUBDIR:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass
+
+
+def download_path(job_id: str, filename: str):
+    """Path of a job's output file, or None if it does not exist or the name escapes the job folder"""
+    path = safe_join(DOWNLOAD_FOLDER, job_id, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+
+def remove_job(job_id: str):
+    path = safe_join(DOWNLOAD_FOLDER, job_id)
+    if path is not None:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _folder_usage(path: str):
+    """(total bytes, last modification time) of a folder and everything in it"""
+    size = 0
+    latest = os.stat(path).st_mtime
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            size += stat.st_size
+            latest = max(latest, stat.st_mtime)
+    return size, latest
+
+
+def usage():
+    """[(last modified, bytes, job id), ...] for every job folder, oldest first"""
+    folders = []
+    try:
+        entries = list(os.scandir(DOWNLOAD_FOLDER))
+    except FileNotFoundError:
+        return folders
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            size, latest = _folder_usage(entry.path)
+        except OSError:
+            continue
+        folders.append((latest, size, entry.name))
+    folders.sort()
+    return folders
+
+
+def cleanup(keep=(), now: float = None):
+    """
+    Delete job folders older than DOWNLOAD_TTL_HOURS, then the oldest ones until the total
+    is within DOWNLOAD_QUOTA_MB; folders of jobs in keep (still queued or running) are never touched
+    Returns counts of expired and evicted folders, bytes freed and bytes still in use
+    """
+    now = time.time() if now is None else now
+    keep = set(keep)
+    stats = {'expired': 0, 'evicted': 0, 'freed_bytes': 0, 'used_bytes': 0}
+    with _cleanup_lock:
+        folders = usage()
+        total = sum(size for _, size, _ in folders)
+        quota = DOWNLOAD_QUOTA_MB * 1024 * 1024
+        for latest, size, job_id in folders:
+            if job_id in keep:
+                continue
+            if DOWNLOAD_TTL_HOURS > 0 and now - latest > DOWNLOAD_TTL_HOURS * 3600:
+                stats['expired'] += 1
+            elif quota > 0 and total > quota:
+                stats['evicted'] += 1
+            else:
+                continue
+            remove_job(job_id)
+            total -= size
+            stats['freed_bytes'] += size
+        stats['used_bytes'] = total
+    if stats['expired'] or stats['evicted']:
+        print(f"Storage cleanup: {stats['expired']} expired and {stats['evicted']} evicted job folders, "
+              f"{stats['freed_bytes'] / 1024 / 1024:.1f} MB freed, {total / 1024 / 1024:.1f} MB in use")
+    return stats
+
+
+def start_cleaner(active_jobs, interval: float = STORAGE_CLEANUP_SECONDS):
+    """Run cleanup in a background thread (once per process); active_jobs() returns job ids to keep"""
+    global _cleaner
+    if _cleaner is not None and _cleaner[0] == os.getpid():
+        return
+
+    def run():
+        while True:
+            try:
+                cleanup(active_jobs())
+            except Exception as e:
+                print(f"  Storage cleanup error: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='storage-cleanup', daemon=True)
+    _cleaner = (os.getpid(), thread)
+    thread.start()
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# Keep the SQLite stores that modules open on import, and any job outputs, out of the working tree
+_SCRATCH = tempfile.mkdtemp(prefix='geocoder-tests-')
+os.environ.setdefault('DATA_DIR', os.path.join(_SCRATCH, 'data'))
+os.environ.setdefault('DOWNLOAD_DIR', os.path.join(_SCRATCH, 'downloads'))
@@ -0,0 +1,76 @@
+from openpyxl import load_workbook
+
+from normalize import normalize_pairs
+from utils import OUTPUT_COLUMNS, carried_result, output_row
+from venue_io import ExcelOutputWriter, open_venue_rows, read_output_meta
+
+VENUES = [
+    ('北京', '故宫', 'pid-gugong', (39.9163, 116.3972)),
+    ('北京', '颐和园', 'pid-yiheyuan', (39.9999, 116.2755)),
+    ('北京', '天坛', 'pid-tiantan', (39.8822, 116.4066)),
+]
+
+
+def write_output(path):
+    writer = ExcelOutputWriter(path, OUTPUT_COLUMNS, meta=True)
+    keys = normalize_pairs([city for city, *_ in VENUES], [place for _, place, *_ in VENUES])['key']
+    for (city, place, place_id, coords), key in zip(VENUES, keys):
+        result = {
+            'address': '',
+            'embed': f'https://www.google.com/maps/embed/v1/place?key=k&q=place_id:{place_id}',
+            'direct': f'https://www.google.com/maps/place/?q=place_id:{place_id}',
+            'coords': coords,
+        }
+        writer.append(output_row(city, place, result), key=key, coords=coords)
+    writer.close()
+
+
+def carried_rows(path):
+    """carried_result for every row of a re-uploaded output workbook, as process_venue_file sees it"""
+    meta = read_output_meta(path)
+    _, rows, _ = open_venue_rows(path)
+    rows = list(rows)
+    queries = normalize_pairs([row[0] for row in rows], [row[1] for row in rows])['query']
+    return [carried_result(row, query, meta) for row, query in zip(rows, queries)]
+
+
+def test_unchanged_rows_keep_their_own_coordinates(tmp_path):
+    path = str(tmp_path / 'v_output.xlsx')
+    write_output(path)
+    results = carried_rows(path)
+    assert [result['coords'] for result in results] == [coords for *_, coords in VENUES]
+    assert results[0]['direct'].endswith('pid-gugong')
+
+
+def test_row_edited_to_another_venue_of_the_file_is_resolved_again(tmp_path):
+    path = str(tmp_path / 'v_output.xlsx')
+    write_output(path)
+    wb = load_workbook(path)
+    # 故宫 renamed to 颐和园: its URLs still point at 故宫, so 颐和园's coordinates must not be used
+    wb['Sheet1']['B2'] = '颐和园'
+    wb.save(path)
+    results = carried_rows(path)
+    assert results[0] is None
+    assert results[1]['coords'] == VENUES[1][3]
+    assert results[2] is not None
+
+
+def test_row_with_edited_urls_is_resolved_again(tmp_path):
+    path = str(tmp_path / 'v_output.xlsx')
+    write_output(path)
+    wb = load_workbook(path)
+    wb['Sheet1']['E4'] = 'https://www.google.com/maps/place/?q=place_id:pid-other'
+    wb.save(path)
+    results = carried_rows(path)
+    assert results[2] is None
+    assert results[0] is not None and results[1] is not None
+
+
+def test_workbook_without_fingerprints_carries_nothing(tmp_path):
+    path = str(tmp_path / 'v_output.xlsx')
+    write_output(path)
+    wb = load_workbook(path)
+    meta_sheet = wb['_geocoder']
+    meta_sheet.delete_cols(4)
+    wb.save(path)
+    assert carried_rows(path) == [None, None, None]
@@ -0,0 +1,62 @@
+import checkpoint
+from checkpoint import Checkpoint, open_checkpoint
+from utils import VenueResolver, gazetteer_result, iter_resolved
+
+
+def stored_result(lat, lng):
+    result = gazetteer_result({'place_id': f'pid-{lat}', 'address': '', 'lat': lat, 'lng': lng})
+    result.update(provider='google', lookups=1, seconds=0.2)
+    return result
+
+
+def input_file(tmp_path, content):
+    path = tmp_path / 'venues.csv'
+    path.write_text(content, encoding='utf-8')
+    return str(path)
+
+
+def test_recorded_rows_survive_a_restart(tmp_path):
+    path = input_file(tmp_path, 'city,venue\n北京,故宫\n北京,天坛\n')
+    first = open_checkpoint(path)
+    assert not first.resumable
+    first.record([(0, stored_result(39.9163, 116.3972)), (1, stored_result(39.8822, 116.4066))])
+
+    # A new run of the same file (as after a crash) finds both rows, coordinates as tuples again
+    second = open_checkpoint(path)
+    assert second.resumable == 2
+    assert second.load(0, 1) == {0: stored_result(39.9163, 116.3972)}
+    assert second.load(1, 5)[1]['coords'] == (39.8822, 116.4066)
+
+    second.finish()
+    assert not open_checkpoint(path).resumable
+
+
+def test_edited_file_does_not_resume(tmp_path):
+    open_checkpoint(input_file(tmp_path, 'city,venue\n北京,故宫\n')).record([(0, stored_result(39.9163, 116.3972))])
+    assert not open_checkpoint(input_file(tmp_path, 'city,venue\n北京,颐和园\n')).resumable
+
+
+def test_stale_checkpoints_are_dropped(tmp_path, monkeypatch):
+    path = input_file(tmp_path, 'city,venue\n上海,外滩\n')
+    open_checkpoint(path).record([(0, stored_result(31.2400, 121.4900))])
+    monkeypatch.setattr(checkpoint, 'CHECKPOINT_TTL_DAYS', 0)
+    assert not open_checkpoint(path).resumable
+
+
+def test_resumed_rows_are_not_looked_up_again():
+    store = Checkpoint('resume-test')
+    store.record([(0, stored_result(39.9163, 116.3972)), (2, stored_result(39.8822, 116.4066))])
+    resumed = Checkpoint('resume-test')
+    resolver = VenueResolver(total=3)
+    seen = []
+    try:
+        # Row 1 has no venue, so every row is answered without a provider call
+        rows = list(iter_resolved([('北京', '故宫'), ('北京', ''), ('北京', '天坛')], resolver, checkpoint=resumed,
+                                  on_row=lambda row_idx, full_name, result, source: seen.append((row_idx, source))))
+    finally:
+        resolver.close()
+    assert [result['coords'] for *_, result in rows] == [(39.9163, 116.3972), None, (39.8822, 116.4066)]
+    assert rows[0][3]['provider'] == 'google'
+    assert resolver.resumed_rows == 2 and resolver.skipped_rows == 1
+    assert resolver.venue_memo.misses == 0
+    assert sorted(seen) == [(0, 'resumed'), (1, 'skipped'), (2, 'resumed')]
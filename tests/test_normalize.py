@@ -0,0 +1,32 @@
+from normalize import normalize_pairs, normalize_query
+
+
+def test_english_city_names_are_kept():
+    cities = ['Kansas City', 'Mexico City', 'Salt Lake City', 'kansas  city']
+    frame = normalize_pairs(cities, ['Union Station', 'Zócalo', 'Temple Square', 'Union Station'])
+    assert frame['city'].tolist() == ['Kansas City', 'Mexico City', 'Salt Lake City', 'kansas city']
+    assert frame['query'].tolist() == ['Kansas City Union Station', 'Mexico City Zócalo',
+                                       'Salt Lake City Temple Square', 'kansas city Union Station']
+    assert frame['key'][0] == frame['key'][3]
+
+
+def test_chinese_city_suffixes_are_dropped():
+    frame = normalize_pairs(['南京市', '香港特别行政区', '浦东新区', '市'], ['先锋书店', '天星码头', '陆家嘴', '广场'])
+    assert frame['city'].tolist() == ['南京', '香港', '浦东新区', '市']
+    assert frame['query'][0] == '南京 先锋书店'
+
+
+def test_cells_are_cleaned():
+    frame = normalize_pairs(['　南京市 ', None], ['先锋　 书店', 'ＡＢＣ１'])
+    assert frame['query'].tolist() == ['南京 先锋书店', 'ABC1']
+
+
+def test_blank_venues():
+    frame = normalize_pairs(['南京', '上海', '北京', '杭州'], ['nan', 'N/A', None, '  '])
+    assert frame['blank'].tolist() == [True, True, True, True]
+    assert frame['query'].tolist() == ['南京', '上海', '北京', '杭州']
+
+
+def test_key_matches_normalize_query():
+    frame = normalize_pairs(['Kansas City', '南京市'], ['Union  Station', 'ＸＹＺ 书店'])
+    assert frame['key'].tolist() == [normalize_query(query) for query in frame['query']]
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import throttle
+from throttle import DailyQuota, ProviderLimiter, ProviderUnavailable
+
+
+def test_daily_budget_is_enforced():
+    quota = DailyQuota('test-budget', 2, 0)
+    quota.reserve()
+    quota.reserve()
+    with pytest.raises(ProviderUnavailable, match='budget of 2'):
+        quota.reserve()
+    status = quota.status()
+    assert status['used_today'] == 2 and status['remaining_today'] == 0
+    assert status['circuit'] == 'closed'
+
+
+def test_exhausted_quota_opens_the_circuit_for_every_worker():
+    quota = DailyQuota('test-trip', 0, 0)
+    quota.reserve()
+    quota.trip('OVER_QUERY_LIMIT')
+    with pytest.raises(ProviderUnavailable, match='OVER_QUERY_LIMIT'):
+        quota.reserve()
+    # Another worker process shares the state through SQLite
+    other = DailyQuota('test-trip', 0, 0)
+    with pytest.raises(ProviderUnavailable):
+        other.reserve()
+    assert other.status()['circuit'] == 'open'
+
+
+def test_half_open_circuit_lets_one_probe_through_and_closes_on_success():
+    quota = DailyQuota('test-probe', 0, 0)
+    quota.trip('daily limit')
+    # The circuit opened longer ago than the probe interval
+    throttle._db.connect().execute(
+        "UPDATE provider_quota SET opened_at = ? WHERE provider = ?",
+        (time.time() - throttle.CIRCUIT_PROBE_MINUTES * 60 - 1, 'test-probe'),
+    )
+    quota.reserve()
+    with pytest.raises(ProviderUnavailable):
+        DailyQuota('test-probe', 0, 0).reserve()
+
+    quota.reset()
+    DailyQuota('test-probe', 0, 0).reserve()
+    assert quota.status()['circuit'] == 'closed'
+
+
+def test_skipped_request_frees_its_slot():
+    limiter = ProviderLimiter('test-slot', max_concurrency=1, rate_per_sec=0)
+    limiter.quota_exhausted('quota used up')
+    for _ in range(3):
+        with pytest.raises(ProviderUnavailable):
+            with limiter:
+                pass
+    assert limiter.busy == 0
+    assert limiter.status()['circuit'] == 'open'
@@ -0,0 +1,29 @@
+import numpy as np
+
+from coordtransform import haversine_m
+from spatial import cluster_points
+
+
+def test_a_street_of_shops_is_not_chained():
+    # 100 shops 15 m apart along a meridian
+    lats = 31.2 + np.arange(100) * 15 / 111_320
+    lngs = np.full(100, 121.4)
+    labels = cluster_points(lats, lngs, 20)
+    assert len(set(labels.tolist())) == 50
+    assert haversine_m(lats, lngs, lats[labels], lngs[labels]).max() <= 20
+
+
+def test_identical_points_share_the_lowest_index():
+    lats = np.array([31.0, 32.0, 31.0, 32.0, 33.0])
+    lngs = np.array([121.0, 121.0, 121.0, 121.0, 121.0])
+    assert cluster_points(lats, lngs, 10).tolist() == [0, 1, 0, 1, 4]
+
+
+def test_every_point_is_within_the_radius_of_its_seed():
+    rng = np.random.default_rng(7)
+    lats = 31 + rng.random(2000) * 0.01
+    lngs = 121 + rng.random(2000) * 0.01
+    labels = cluster_points(lats, lngs, 30)
+    assert (labels <= np.arange(len(labels))).all()
+    assert (labels[labels] == labels).all()
+    assert haversine_m(lats, lngs, lats[labels], lngs[labels]).max() <= 30
@@ -0,0 +1,295 @@
+import os
+import sqlite3
+import threading
+import time
+
+from localdb import DATA_DIR, LocalDB
+
+# ====== Quota settings ======
+QUOTA_DB_PATH = os.environ.get('QUOTA_DB_PATH', os.path.join(DATA_DIR, 'quota.sqlite3'))
+# After a rate-limit answer the request rate is halved, then climbs back over this many seconds
+RATE_RECOVERY_SECONDS = float(os.environ.get('RATE_RECOVERY_SECONDS', '30'))
+# An open circuit lets one probe request through this often, in case the quota was raised
+CIRCUIT_PROBE_MINUTES = float(os.environ.get('CIRCUIT_PROBE_MINUTES', '60'))
+
+# Open-circuit state written by another worker is picked up within this many seconds
+_CIRCUIT_REFRESH = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS provider_quota (
+    provider TEXT NOT NULL,
+    day TEXT NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    opened_at REAL,
+    reason TEXT,
+    PRIMARY KEY (provider, day)
+);
+"""
+
+_db = LocalDB(QUOTA_DB_PATH, _SCHEMA)
+
+
+class ProviderUnavailable(Exception):
+    """The provider's daily quota is used up; calls are skipped until it resets"""
+
+
+class TokenBucket:
+    """
+    Request-rate limiter that backs off on rate-limit answers
+    The rate is halved on each rate-limit answer and recovers linearly to the configured rate
+    """
+
+    def __init__(self, rate_per_sec: float, burst: int = 1):
+        self.target_rate = float(rate_per_sec)
+        self.burst = max(1, int(burst))
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._penalty_rate = None
+        self._penalty_at = 0.0
+
+    def _rate(self, now: float):
+        if self._penalty_rate is None:
+            return self.target_rate
+        progress = (now - self._penalty_at) / RATE_RECOVERY_SECONDS if RATE_RECOVERY_SECONDS > 0 else 1.0
+        if progress >= 1.0:
+            self._penalty_rate = None
+            return self.target_rate
+        return self._penalty_rate + (self.target_rate - self._penalty_rate) * progress
+
+    @property
+    def rate(self):
+        with self._lock:
+            return self._rate(time.monotonic())
+
+    def acquire(self):
+        """Wait for a token (no-op when the rate is unlimited)"""
+        if self.target_rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            rate = self._rate(now)
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * rate)
+            self._last = now
+            # Tokens may go negative: each caller reserves its slot and sleeps outside the lock
+            self._tokens -= 1
+            delay = -self._tokens / rate if self._tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+
+    def penalize(self):
+        """A rate-limit answer: halve the current rate and drop any saved-up burst"""
+        if self.target_rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._penalty_rate = max(self._rate(now) / 2, self.target_rate / 16)
+            self._penalty_at = now
+            self._tokens = min(self._tokens, 0.0)
+
+
+class DailyQuota:
+    """
+    Requests used per provider per quota day, shared by all workers through SQLite
+    Also holds the circuit breaker that opens when the provider reports its quota exhausted
+    """
+
+    def __init__(self, provider: str, daily_limit: int, reset_utc_offset: float):
+        self.provider = provider
+        self.daily_limit = max(0, int(daily_limit))
+        self.reset_utc_offset = float(reset_utc_offset)
+        self._lock = threading.Lock()
+        self._circuit = (None, None, None)
+        self._checked_at = 0.0
+        self._known_day = None
+
+    def day(self, now: float = None):
+        """Current quota day in the provider's reset timezone"""
+        now = time.time() if now is None else now
+        return time.strftime('%Y-%m-%d', time.gmtime(now + self.reset_utc_offset * 3600))
+
+    def resets_at(self, now: float = None):
+        """Epoch seconds of the next quota reset"""
+        now = time.time() if now is None else now
+        local = now + self.reset_utc_offset * 3600
+        return local - local % 86400 + 86400 - self.reset_utc_offset * 3600
+
+    def _connect(self, day: str):
+        conn = _db.connect()
+        if day != self._known_day:
+            conn.execute("INSERT OR IGNORE INTO provider_quota (provider, day) VALUES (?, ?)", (self.provider, day))
+            self._known_day = day
+        return conn
+
+    def _open_circuit(self, day: str):
+        """(opened_at, reason) of today's open circuit, or (None, None); cached for a few seconds"""
+        now = time.monotonic()
+        with self._lock:
+            cached_day, opened_at, reason = self._circuit
+            if cached_day == day and now - self._checked_at < _CIRCUIT_REFRESH:
+                return opened_at, reason
+        row = _db.connect().execute(
+            "SELECT opened_at, reason FROM provider_quota WHERE provider = ? AND day = ?", (self.provider, day)
+        ).fetchone()
+        opened_at, reason = row if row else (None, None)
+        with self._lock:
+            self._circuit = (day, opened_at, reason)
+            self._checked_at = now
+        return opened_at, reason
+
+    def reserve(self):
+        """
+        Count one request against today's budget
+        Raises ProviderUnavailable when the circuit is open or the budget is spent
+        """
+        now = time.time()
+        day = self.day(now)
+        try:
+            opened_at, reason = self._open_circuit(day)
+            if opened_at is not None:
+                if now - opened_at < CIRCUIT_PROBE_MINUTES * 60:
+                    raise ProviderUnavailable(f"{self.provider} circuit open: {reason}")
+                # Half-open: this request probes whether the quota is back; others keep skipping
+                conn = self._connect(day)
+                probed = conn.execute(
+                    "UPDATE provider_quota SET opened_at = ? WHERE provider = ? AND day = ? AND opened_at = ?",
+                    (now, self.provider, day, opened_at),
+                ).rowcount
+                self._forget_circuit()
+                if not probed:
+                    raise ProviderUnavailable(f"{self.provider} circuit open: {reason}")
+
+            conn = self._connect(day)
+            reserved = conn.execute(
+                "UPDATE provider_quota SET used = used + 1 WHERE provider = ? AND day = ? AND (? = 0 OR used < ?)",
+                (self.provider, day, self.daily_limit, self.daily_limit),
+            ).rowcount
+        except sqlite3.Error as e:
+            # Quota bookkeeping must never stop geocoding
+            print(f"  Quota store error: {e}")
+            return
+        if not reserved:
+            raise ProviderUnavailable(f"{self.provider} daily budget of {self.daily_limit} requests used")
+
+    def trip(self, reason: str):
+        """The provider reported its quota exhausted: skip it until the next reset"""
+        day = self.day()
+        try:
+            opened = self._connect(day).execute(
+                "UPDATE provider_quota SET opened_at = ?, reason = ? WHERE provider = ? AND day = ? AND opened_at IS NULL",
+                (time.time(), reason, self.provider, day),
+            ).rowcount
+        except sqlite3.Error as e:
+            print(f"  Quota store error: {e}")
+            return
+        self._forget_circuit()
+        if opened:
+            print(f"{self.provider}: quota exhausted ({reason}), skipping it until "
+                  f"{time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(self.resets_at()))}")
+
+    def reset(self):
+        """A request got through: close the circuit"""
+        day = self.day()
+        opened_at, _ = self._open_circuit(day)
+        if opened_at is None:
+            return
+        try:
+            _db.connect().execute(
+                "UPDATE provider_quota SET opened_at = NULL, reason = NULL WHERE provider = ? AND day = ?",
+                (self.provider, day),
+            )
+        except sqlite3.Error as e:
+            print(f"  Quota store error: {e}")
+        self._forget_circuit()
+        print(f"{self.provider}: quota available again, circuit closed")
+
+    def _forget_circuit(self):
+        with self._lock:
+            self._circuit = (None, None, None)
+
+    def status(self):
+        now = time.time()
+        day = self.day(now)
+        row = _db.connect().execute(
+            "SELECT used, opened_at, reason FROM provider_quota WHERE provider = ? AND day = ?", (self.provider, day)
+        ).fetchone()
+        used, opened_at, reason = row if row else (0, None, None)
+        return {
+            'day': day,
+            'daily_limit': self.daily_limit or None,
+            'used_today': used,
+            'remaining_today': max(self.daily_limit - used, 0) if self.daily_limit else None,
+            'resets_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.resets_at(now))),
+            'circuit': 'open' if opened_at is not None else 'closed',
+            'circuit_reason': reason,
+        }
+
+
+class ProviderLimiter:
+    """
+    Governs requests to one provider: caps concurrent in-flight requests, paces them with an
+    adaptive token bucket and counts them against a daily quota with a circuit breaker
+    """
+
+    def __init__(self, name: str, max_concurrency: int, rate_per_sec: float, burst: int = 1,
+                 daily_limit: int = 0, reset_utc_offset: float = 0):
+        self.name = name
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.rate_per_sec = float(rate_per_sec)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.bucket = TokenBucket(self.rate_per_sec, burst)
+        self.quota = DailyQuota(name, daily_limit, reset_utc_offset)
+        self._count_lock = threading.Lock()
+        self._waiting_or_active = 0
+
+    @property
+    def busy(self):
+        """Requests currently in flight or waiting for a slot"""
+        return self._waiting_or_active
+
+    def _track(self, delta: int):
+        with self._count_lock:
+            self._waiting_or_active += delta
+
+    def __enter__(self):
+        self._track(1)
+        try:
+            self._slots.acquire()
+        except BaseException:
+            self._track(-1)
+            raise
+        try:
+            self.bucket.acquire()
+            self.quota.reserve()
+        except BaseException:
+            self._slots.release()
+            self._track(-1)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._slots.release()
+        self._track(-1)
+        return False
+
+    def rate_limited(self):
+        """The provider answered with a per-second rate limit"""
+        self.bucket.penalize()
+
+    def quota_exhausted(self, reason: str):
+        """The provider answered that its daily quota is used up"""
+        self.quota.trip(reason)
+
+    def succeeded(self):
+        """A request was answered normally (closes a half-open circuit)"""
+        self.quota.reset()
+
+    def status(self):
+        """Budget left and current throttle state, for the /quota endpoint"""
+        status = self.quota.status()
+        status.update({
+            'max_concurrency': self.max_concurrency,
+            'rate_per_sec': self.rate_per_sec or None,
+            'current_rate_per_sec': round(self.bucket.rate, 2) if self.rate_per_sec > 0 else None,
+        })
+        return status
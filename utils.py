@@ -1,23 +1,71 @@
 import os
-import requests
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+import numpy as np
 import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import quote
 
+from checkpoint import open_checkpoint
+from coordtransform import gcj02_to_wgs84, haversine_m
+from gazetteer import GAZETTEER
+from geocache import GEOCODE_CACHE, MISS
+from kml import KML_FORMAT, KmlWriter, summary_lines
+from metrics import (GOOGLE_LOCATION_TYPES, HEDGES, PROVIDER_SKIPPED, ROWS_PROCESSED, STAGE_SECONDS,
+                     VENUE_OUTCOMES, StageTimings)
+from normalize import normalize_pairs, normalize_query
+from providers import GOOGLE_CLIENT, AMAP_CLIENT
+from throttle import ProviderUnavailable
+from venue_io import ExcelOutputWriter, iter_chunks, open_venue_rows, read_output_meta, recorded_coords
+
 # ====== API Keys - Should be set as environment variables ======
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY', '')
 AMAP_API_KEY = os.environ.get('AMAP_API_KEY', '')
 
+# ====== Concurrency settings ======
+# Number of rows resolved at the same time
+# (per-provider concurrency and rate caps live in providers.py)
+GEOCODE_WORKERS = int(os.environ.get('GEOCODE_WORKERS', '16'))
+
+# ====== Amap coordinate mode ======
+# 'google': geocode Amap's address through Google again for KML coordinates (extra call)
+# 'local': convert Amap's GCJ-02 coordinates to WGS-84 locally (no extra call)
+AMAP_COORDS_MODE = os.environ.get('AMAP_COORDS_MODE', 'google').lower()
+# In local mode, this many Amap hits per run are also geocoded through Google to report the offset
+AMAP_COORDS_VERIFY_SAMPLE = int(os.environ.get('AMAP_COORDS_VERIFY_SAMPLE', '5'))
+
+# ====== Hedged Amap lookups ======
+# 'off': Amap is only asked after Google answers APPROXIMATE or nothing
+# 'cjk': rows whose name has CJK characters ask Amap at the same time as Google
+# 'adaptive': rows of cities whose recent Google answers were mostly APPROXIMATE ask Amap at the same time
+HEDGE_MODE = os.environ.get('HEDGE_MODE', 'off').lower()
+# adaptive mode: share of APPROXIMATE answers among a city's last HEDGE_WINDOW Google results
+HEDGE_APPROX_RATIO = float(os.environ.get('HEDGE_APPROX_RATIO', '0.5'))
+HEDGE_WINDOW = int(os.environ.get('HEDGE_WINDOW', '20'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', '3'))
+
+# ====== In-run dedup ======
+# Distinct venue queries (and Amap addresses) whose results are kept in memory for later rows;
+# older repeats are answered from the geocode cache, so memory does not grow with the file
+MEMO_MAX_ENTRIES = int(os.environ.get('MEMO_MAX_ENTRIES', '5000'))
+
+_CJK = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+
 def geocode_google(address: str):
     """Use Google Geocoding API to get coordinates and quality info"""
     if not GOOGLE_API_KEY:
         return None
     
-    url = "https://maps.googleapis.com/maps/api/geocode/json"
+    cached = GEOCODE_CACHE.get('google', address)
+    if cached is not MISS:
+        return cached
+    
     params = {"address": address, "key": GOOGLE_API_KEY}
     
     try:
-        r = requests.get(url, params=params, timeout=10)
-        data = r.json()
+        data = GOOGLE_CLIENT.get_json(params)
         if data.get("status") == "OK" and data.get("results"):
             result = data["results"][0]
             loc = result["geometry"]["location"]
@@ -25,13 +73,22 @@ def geocode_google(address: str):
             formatted_address = result.get("formatted_address", "")
             place_id = result.get("place_id", "")
             
-            return {
+            google_result = {
                 'lat': loc["lat"],
                 'lng': loc["lng"],
                 'location_type': location_type,
                 'formatted_address': formatted_address,
                 'place_id': place_id
             }
+            GEOCODE_CACHE.put('google', address, google_result)
+            return google_result
+        if data.get("status") == "ZERO_RESULTS":
+            # Definitive "not found" - cache it so the query isn't paid for again
+            GEOCODE_CACHE.put('google', address, None)
+    except ProviderUnavailable as e:
+        # Quota exhausted: skip Google without a network call (not cached, so it is retried after the reset)
+        PROVIDER_SKIPPED.inc(provider='google')
+        print(f"  Google skipped: {e}")
     except Exception as e:
         print(f"Google geocoding error: {e}")
     
@@ -43,7 +100,10 @@ def get_amap_address(keywords: str):
         print(f"  Amap API key not found!")
         return None
     
-    url = "https://restapi.amap.com/v3/place/text"
+    cached = GEOCODE_CACHE.get('amap', keywords)
+    if cached is not MISS:
+        return cached
+    
     params = {
         "keywords": keywords,
         "key": AMAP_API_KEY,
@@ -52,9 +112,7 @@ def get_amap_address(keywords: str):
     }
     
     try:
-        r = requests.get(url, params=params, timeout=10)
-        r.encoding = 'utf-8'
-        data = r.json()
+        data = AMAP_CLIENT.get_json(params)
         
         # Debug: print Amap response status
         status = data.get("status", "unknown")
@@ -97,15 +155,25 @@ def get_amap_address(keywords: str):
                 
                 print(f"  Amap returned Chinese address: {full_address}")
                 
-                return {
+                amap_result = {
                     'address': full_address,
                     'lat': float(lat_str),
                     'lng': float(lng_str)
                 }
+                GEOCODE_CACHE.put('amap', keywords, amap_result)
+                return amap_result
             else:
                 print(f"  Amap: No location or address in result")
+                GEOCODE_CACHE.put('amap', keywords, None)
+        elif data.get("status") == "1":
+            print(f"  Amap: No results found for '{keywords}'")
+            GEOCODE_CACHE.put('amap', keywords, None)
         else:
             print(f"  Amap: No results found for '{keywords}'")
+    except ProviderUnavailable as e:
+        # Quota exhausted: skip Amap without a network call (not cached, so it is retried after the reset)
+        PROVIDER_SKIPPED.inc(provider='amap')
+        print(f"  Amap skipped: {e}")
     except Exception as e:
         print(f"  Amap search error: {e}")
     
@@ -151,182 +219,809 @@ def build_google_urls_from_place_id(place_id: str):
 
 def detect_columns(df: pd.DataFrame):
     """Automatically detect city and place column names"""
+    return detect_header_columns(list(df.columns))
+
+def detect_header_columns(columns):
+    """Automatically detect city and place column names from a list of header names"""
     city_col = None
     place_col = None
     
-    for col in df.columns:
+    for col in columns:
         col_lower = str(col).lower()
         if city_col is None and ("城" in col or "city" in col_lower or "市" in col):
             city_col = col
         if place_col is None and ("景" in col or "点" in col or "店" in col or "name" in col_lower or "地点" in col or "场所" in col):
             place_col = col
     
-    if city_col is None and len(df.columns) >= 1:
-        city_col = df.columns[0]
-    if place_col is None and len(df.columns) >= 2:
-        place_col = df.columns[1]
+    if city_col is None and len(columns) >= 1:
+        city_col = columns[0]
+    if place_col is None and len(columns) >= 2:
+        place_col = columns[1]
     
     if city_col is None or place_col is None:
-        raise ValueError(f"Cannot detect city and place columns. Available columns: {list(df.columns)}")
+        raise ValueError(f"Cannot detect city and place columns. Available columns: {list(columns)}")
     
     return city_col, place_col
 
-def process_venue_file(input_path: str, output_dir: str):
+class LookupMemo:
     """
-    Process an Excel file with venue data
-    Returns a dictionary with success status and file paths
+    Per-run memo so each distinct lookup is made once, even when rows race for it
+    Only the max_entries most recently used results are kept; in-flight lookups are never dropped
     """
-    try:
-        df = pd.read_excel(input_path)
-        city_col, place_col = detect_columns(df)
+    
+    def __init__(self, max_entries: int = None):
+        self.max_entries = MEMO_MAX_ENTRIES if max_entries is None else max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def lookup(self, key, compute):
+        """(value, shared): shared is True when another row already made (or is making) the lookup"""
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = Future()
+                self.misses += 1
+                self._evict()
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if owner:
+            try:
+                entry.set_result(compute())
+            except BaseException as e:
+                entry.set_exception(e)
+        return entry.result(), not owner
+    
+    def get_or_compute(self, key, compute):
+        return self.lookup(key, compute)[0]
+    
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            key, entry = next(iter(self._entries.items()))
+            if not entry.done():
+                break
+            del self._entries[key]
+    
+    def __len__(self):
+        return len(self._entries)
+
+class HedgePolicy:
+    """
+    Decides which rows start the Amap search together with the first Google geocode (HEDGE_MODE)
+    The early Amap answer is only used where the Google -> Amap fallback would have asked Amap anyway;
+    otherwise it is cancelled if still queued, or counted as wasted
+    """
+    
+    def __init__(self, mode: str = None):
+        self.mode = (mode or HEDGE_MODE).lower()
+        self.executor = None
+        if self.mode != 'off':
+            # Sized to Amap's concurrency cap so extra hedges wait here, where they can still be cancelled
+            self.executor = ThreadPoolExecutor(
+                max_workers=AMAP_CLIENT.limiter.max_concurrency, thread_name_prefix='amap-hedge'
+            )
+        self._lock = threading.Lock()
+        self._recent = {}
+        self._pending = 0
+        self.counts = {'hedged': 0, 'used': 0, 'wasted': 0, 'cancelled': 0}
+    
+    def should_hedge(self, full_name: str, city=None):
+        # Only hedge into spare Amap capacity, so early searches never delay searches rows actually need
+        limiter = AMAP_CLIENT.limiter
+        if limiter.busy + self._pending >= limiter.max_concurrency:
+            return False
+        if self.mode == 'cjk':
+            return _CJK.search(full_name) is not None
+        if self.mode == 'adaptive':
+            with self._lock:
+                recent = self._recent.get(city)
+                if recent is None or len(recent) < HEDGE_MIN_SAMPLES:
+                    return False
+                return sum(recent) / len(recent) >= HEDGE_APPROX_RATIO
+        return False
+    
+    def observe(self, city, google_result):
+        """Remember whether Google's answer for a row of this city was APPROXIMATE (or missing)"""
+        if self.mode != 'adaptive':
+            return
+        approximate = google_result is None or google_result['location_type'] == "APPROXIMATE"
+        with self._lock:
+            self._recent.setdefault(city, deque(maxlen=HEDGE_WINDOW)).append(approximate)
+    
+    def submit(self, keywords: str):
+        self._count('hedged')
+        with self._lock:
+            self._pending += 1
         
-        address_list, direct_urls, embed_urls = [], [], []
-        coords_for_kml = []
+        def search():
+            # Counted as pending until the search holds (or waits for) an Amap slot
+            with self._lock:
+                self._pending -= 1
+            return get_amap_address(keywords)
         
-        for idx, row in df.iterrows():
-            city = str(row[city_col]).strip()
-            place = str(row[place_col]).strip()
-            full_name = f"{city} {place}"
-            
-            print(f"Processing: {full_name}")
+        def on_done(future):
+            if future.cancelled():
+                with self._lock:
+                    self._pending -= 1
+        
+        future = self.executor.submit(search)
+        future.add_done_callback(on_done)
+        return future
+    
+    def use(self, future: Future, keywords: str):
+        """The fallback needs Amap: wait for the early answer, or search now if it has not started yet"""
+        if future.cancel():
+            # Still queued behind other hedges: searching on this row's own thread is no slower
+            self._count('cancelled')
+            return get_amap_address(keywords)
+        self._count('used')
+        return future.result()
+    
+    def discard(self, future: Future):
+        """Google was precise: drop the early Amap search; returns True if the call was made anyway"""
+        if future.cancel():
+            self._count('cancelled')
+            return False
+        self._count('wasted')
+        return True
+    
+    def _count(self, name: str):
+        HEDGES.inc(result=name)
+        with self._lock:
+            self.counts[name] += 1
+    
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+def resolve_venue(full_name: str, address_memo: LookupMemo = None, hedge: HedgePolicy = None, city=None):
+    """
+    Resolve one venue with the Google -> Amap -> Google fallback
+    address_memo shares the Amap-address -> Google geocodes between rows of a run
+    hedge (if given) may start the Amap search alongside the first Google geocode
+    Returns a dictionary with the address, URLs, KML coordinates (or None),
+    Amap's raw GCJ-02 point in local coordinate mode, the provider that resolved it (or None),
+    the number of provider lookups made and the time taken in seconds
+    """
+    print(f"Processing: {full_name}")
+    
+    started = time.perf_counter()
+    lookups = [0]
+    
+    hedged = None
+    if hedge is not None and hedge.should_hedge(full_name, city):
+        print(f"  Starting Amap search alongside Google (hedged)")
+        hedged = hedge.submit(full_name)
+    
+    def amap_lookup():
+        lookups[0] += 1
+        if hedged is not None:
+            return hedge.use(hedged, full_name)
+        return get_amap_address(full_name)
+    
+    def geocode_chinese_address(address):
+        def compute():
+            lookups[0] += 1
+            return geocode_google(address)
+        if address_memo is None:
+            return compute()
+        return address_memo.get_or_compute(normalize_query(address), compute)
+    
+    gcj02 = [None]
+    
+    def amap_hit_coords(amap_result):
+        """KML coordinates for an Amap hit (None if unavailable or converted locally later)"""
+        if AMAP_COORDS_MODE == 'local':
+            # Keep Amap's GCJ-02 point; resolve_chunk converts the whole chunk to WGS-84
+            print(f"  Using Amap coordinates (converted to WGS-84 locally)")
+            gcj02[0] = (amap_result['lng'], amap_result['lat'])
+            return None
+        
+        # Geocode the Chinese address through Google to get Google coordinates
+        print(f"  Geocoding Chinese address through Google...")
+        google_from_chinese = geocode_chinese_address(amap_result['address'])
+        
+        if google_from_chinese:
+            lat = google_from_chinese['lat']
+            lng = google_from_chinese['lng']
+            print(f"  Google coordinates from Chinese address: {lat}, {lng}")
+            return (lat, lng)
+        print(f"  Google could not geocode Chinese address")
+        return None
+    
+    lookups[0] += 1
+    google_result = geocode_google(full_name)
+    address = ""
+    coords = None
+    outcome = 'not_found'
+    GOOGLE_LOCATION_TYPES.inc(location_type=google_result['location_type'] if google_result else 'none')
+    if hedge is not None:
+        hedge.observe(city, google_result)
+    
+    if google_result is not None:
+        location_type = google_result['location_type']
+        formatted_address = google_result['formatted_address']
+        place_id = google_result['place_id']
+        
+        # Only fallback to Amap if Google's result is APPROXIMATE
+        if location_type == "APPROXIMATE":
+            print(f"  Google result is APPROXIMATE: {formatted_address}")
+            print(f"  Trying Amap for more specific location...")
             
-            google_result = geocode_google(full_name)
-            address = ""
+            amap_result = amap_lookup()
             
-            if google_result is not None:
-                location_type = google_result['location_type']
-                formatted_address = google_result['formatted_address']
-                place_id = google_result['place_id']
+            if amap_result:
+                address = amap_result['address']
+                outcome = 'amap_fallback'
                 
-                # Only fallback to Amap if Google's result is APPROXIMATE
-                if location_type == "APPROXIMATE":
-                    print(f"  Google result is APPROXIMATE: {formatted_address}")
-                    print(f"  Trying Amap for more specific location...")
-                    
-                    amap_result = get_amap_address(full_name)
-                    
-                    if amap_result:
-                        address = amap_result['address']
-                        
-                        print(f"  Found on Amap: {address}")
-                        
-                        # Geocode the Chinese address through Google to get Google coordinates
-                        print(f"  Geocoding Chinese address through Google...")
-                        google_from_chinese = geocode_google(address)
-                        
-                        if google_from_chinese:
-                            lat = google_from_chinese['lat']
-                            lng = google_from_chinese['lng']
-                            print(f"  Google coordinates from Chinese address: {lat}, {lng}")
-                            coords_for_kml.append((lat, lng, full_name))
-                        else:
-                            print(f"  Google could not geocode Chinese address")
-                        
-                        # Use the Chinese address for Google Maps URLs
-                        direct, embed = build_google_urls_from_address(address)
-                    else:
-                        # Amap also failed - skip this venue entirely
-                        print(f"  Amap also failed, skipping this venue (no KML, no URLs)")
-                        direct, embed = "", ""
-                        # Don't add to coords_for_kml
-                else:
-                    # Google found it with good precision (ROOFTOP, RANGE_INTERPOLATED, GEOMETRIC_CENTER)
-                    print(f"  Found on Google with {location_type} precision")
-                    print(f"  Place ID: {place_id}")
-                    lat = google_result['lat']
-                    lng = google_result['lng']
-                    # ADDRESS RULE: Leave address empty when Google is used
-                    address = ""
-                    # Use place_id for URLs (simplest and most reliable format)
-                    direct, embed = build_google_urls_from_place_id(place_id)
-                    coords_for_kml.append((lat, lng, full_name))
-            else:
-                print(f"  Google failed, trying Amap...")
-                amap_result = get_amap_address(full_name)
+                print(f"  Found on Amap: {address}")
                 
-                if amap_result:
-                    address = amap_result['address']
-                    
-                    print(f"  Found on Amap: {address}")
-                    
-                    # Geocode the Chinese address through Google to get Google coordinates
-                    print(f"  Geocoding Chinese address through Google...")
-                    google_from_chinese = geocode_google(address)
-                    
-                    if google_from_chinese:
-                        lat = google_from_chinese['lat']
-                        lng = google_from_chinese['lng']
-                        print(f"  Google coordinates from Chinese address: {lat}, {lng}")
-                        coords_for_kml.append((lat, lng, full_name))
-                    else:
-                        print(f"  Google could not geocode Chinese address")
-                    
-                    # Use the Chinese address for Google Maps URLs
-                    direct, embed = build_google_urls_from_address(address)
-                else:
-                    print(f"  Could not find: {full_name}")
-                    direct, embed = "", ""
+                coords = amap_hit_coords(amap_result)
+                
+                # Use the Chinese address for Google Maps URLs
+                direct, embed = build_google_urls_from_address(address)
+            else:
+                # Amap also failed - skip this venue entirely
+                print(f"  Amap also failed, skipping this venue (no KML, no URLs)")
+                direct, embed = "", ""
+                # Don't add to coords_for_kml
+        else:
+            # Google found it with good precision (ROOFTOP, RANGE_INTERPOLATED, GEOMETRIC_CENTER)
+            print(f"  Found on Google with {location_type} precision")
+            print(f"  Place ID: {place_id}")
+            if hedged is not None and hedge.discard(hedged):
+                lookups[0] += 1
+            lat = google_result['lat']
+            lng = google_result['lng']
+            # ADDRESS RULE: Leave address empty when Google is used
+            address = ""
+            # Use place_id for URLs (simplest and most reliable format)
+            direct, embed = build_google_urls_from_place_id(place_id)
+            coords = (lat, lng)
+            outcome = 'google'
+    else:
+        print(f"  Google failed, trying Amap...")
+        amap_result = amap_lookup()
+        
+        if amap_result:
+            address = amap_result['address']
+            outcome = 'amap_fallback'
+            
+            print(f"  Found on Amap: {address}")
             
-            address_list.append(address)
-            direct_urls.append(direct)
-            embed_urls.append(embed)
-        
-        # ============================================================
-        # WORKFLOW REQUIREMENT: Output must have ONLY these 5 columns
-        # in this exact order:
-        # 1. city
-        # 2. venue
-        # 3. address
-        # 4. google_maps_embed_url
-        # 5. google_maps_direct_url
-        # ============================================================
-        output_df = pd.DataFrame({
-            'city': df[city_col],
-            'venue': df[place_col],
-            'address': address_list,
-            'google_maps_embed_url': embed_urls,
-            'google_maps_direct_url': direct_urls
-        })
-        
-        base_name = os.path.basename(input_path).replace(".xlsx", "").replace(".xls", "")
-        excel_filename = f"{base_name}_output.xlsx"
-        kml_filename = f"{base_name}.kml"
+            coords = amap_hit_coords(amap_result)
+            
+            # Use the Chinese address for Google Maps URLs
+            direct, embed = build_google_urls_from_address(address)
+        else:
+            print(f"  Could not find: {full_name}")
+            direct, embed = "", ""
+    
+    VENUE_OUTCOMES.inc(outcome=outcome)
+    return {
+        'address': address,
+        'direct': direct,
+        'embed': embed,
+        'coords': coords,
+        'gcj02': gcj02[0],
+        'provider': {'google': 'google', 'amap_fallback': 'amap'}.get(outcome),
+        'lookups': lookups[0],
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+class VenueResolver:
+    """
+    Resolves venues for one run, chunk by chunk, with a shared thread pool
+    Rows with the same normalized query are resolved once and fanned back out (within a chunk,
+    and across chunks while the query is still in the bounded memo), and Amap's GCJ-02 points are converted in one vectorized pass per chunk (local mode)
+    """
+    
+    def __init__(self, workers: int = None, progress=None, total: int = None, hedge_mode: str = None):
+        self.workers = workers or GEOCODE_WORKERS
+        self.progress = progress
+        self.total = total
+        self.venue_memo = LookupMemo()
+        self.address_memo = LookupMemo()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.hedge = HedgePolicy(hedge_mode)
+        self._lock = threading.Lock()
+        self.rows = 0
+        self.rows_done = 0
+        self.resumed_rows = 0
+        self.carried_rows = 0
+        self.skipped_rows = 0
+        self.gazetteer_rows = 0
+        self.duplicate_rows = 0
+        self.venue_lookups_saved = 0
+        self.converted = 0
+        self.offsets = []
+    
+    def _resolve_key(self, key, full_name, city=None):
+        return self.venue_memo.lookup(
+            key, lambda: resolve_venue(full_name, self.address_memo, hedge=self.hedge, city=city)
+        )
+    
+    def _on_done(self, count):
+        # Reported under the lock so callers always see increasing counts
+        with self._lock:
+            self.rows_done += count
+            if self.progress is not None:
+                self.progress(self.rows_done, max(self.total or 0, self.rows_done))
+    
+    def add_resumed(self, count: int):
+        """Count rows whose results came from a checkpoint instead of being resolved"""
+        self.rows += count
+        self.resumed_rows += count
+        self._on_done(count)
+    
+    def add_carried(self, count: int):
+        """Count rows kept unchanged from an earlier output workbook"""
+        self.rows += count
+        self.carried_rows += count
+        self._on_done(count)
+    
+    def add_skipped(self, count: int):
+        """Count rows without a venue name, which are written out without a lookup"""
+        self.rows += count
+        self.skipped_rows += count
+        self._on_done(count)
+    
+    def add_gazetteer(self, count: int):
+        """Count rows answered from the local gazetteer without provider calls"""
+        self.rows += count
+        self.gazetteer_rows += count
+        self._on_done(count)
+    
+    def resolve_chunk(self, full_names, on_rows_done=None, cities=None):
+        """
+        Resolve a chunk of rows concurrently, returning results in input order
+        on_rows_done(row_indices, result) is called as soon as each group of rows is resolved
+        cities (optional, per row) lets adaptive hedging learn Google's precision per city
+        """
+        # Dedup stage: one resolution per normalized query, remembering which rows share it
+        rows_by_key = {}
+        for idx, full_name in enumerate(full_names):
+            rows_by_key.setdefault(normalize_query(full_name), []).append(idx)
+        
+        def report(future, rows):
+            if on_rows_done is not None and future.exception() is None:
+                on_rows_done(rows, future.result()[0])
+            self._on_done(len(rows))
+        
+        futures = []
+        for key, rows in rows_by_key.items():
+            city = cities[rows[0]] if cities is not None else None
+            future = self.executor.submit(self._resolve_key, key, full_names[rows[0]], city)
+            future.add_done_callback(lambda f, rows=rows: report(f, rows))
+            futures.append((key, rows, future))
+        
+        results = [None] * len(full_names)
+        for key, rows, future in futures:
+            result, shared = future.result()
+            for idx in rows:
+                results[idx] = result
+            # Every row after a query's first occurrence would have repeated its lookups
+            duplicates = len(rows) - (0 if shared else 1)
+            self.duplicate_rows += duplicates
+            self.venue_lookups_saved += result['lookups'] * duplicates
+        self.rows += len(full_names)
+        
+        converted, offsets = convert_amap_coords(
+            [future.result()[0] for _, _, future in futures],
+            self.address_memo,
+            sample_size=AMAP_COORDS_VERIFY_SAMPLE - len(self.offsets),
+        )
+        self.converted += converted
+        self.offsets.extend(offsets)
+        return results
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.hedge.close()
+    
+    def stats(self):
+        """Dedup and coordinate-conversion counters for the run so far"""
+        stats = {
+            'rows': self.rows,
+            'resumed_rows': self.resumed_rows,
+            'carried_rows': self.carried_rows,
+            'skipped_rows': self.skipped_rows,
+            'gazetteer_rows': self.gazetteer_rows,
+            'unique_queries': self.venue_memo.misses,
+            'duplicate_rows': self.duplicate_rows,
+            'address_lookups_shared': self.address_memo.hits,
+            'lookups_saved': self.venue_lookups_saved + self.address_memo.hits
+        }
+        if self.hedge.mode != 'off':
+            stats['hedges'] = dict(self.hedge.counts)
+        if self.converted:
+            gcj02 = {'converted': self.converted, 'sampled': len(self.offsets)}
+            if self.offsets:
+                offsets = np.array(self.offsets)
+                gcj02.update({
+                    'mean_offset_m': round(float(offsets.mean()), 1),
+                    'median_offset_m': round(float(np.median(offsets)), 1),
+                    'max_offset_m': round(float(offsets.max()), 1)
+                })
+            stats['gcj02'] = gcj02
+        return stats
+
+def convert_amap_coords(results, address_memo: LookupMemo = None, sample_size: int = AMAP_COORDS_VERIFY_SAMPLE):
+    """
+    Local coordinate mode: convert every pending Amap GCJ-02 point in a batch to WGS-84 in one NumPy pass
+    Up to sample_size converted points are also geocoded through Google to measure the offset
+    Returns (number converted, list of offsets in metres)
+    """
+    pending = [result for result in results if result.get('gcj02') and result['coords'] is None]
+    if not pending:
+        return 0, []
+    
+    gcj = np.array([result['gcj02'] for result in pending], dtype=float)
+    wgs_lng, wgs_lat = gcj02_to_wgs84(gcj[:, 0], gcj[:, 1])
+    for result, lat, lng in zip(pending, wgs_lat, wgs_lng):
+        result['coords'] = (round(float(lat), 7), round(float(lng), 7))
+    
+    sample = pending[:max(sample_size, 0)]
+    if not sample:
+        return len(pending), []
+    
+    def google_point(result):
+        address = result['address']
+        if address_memo is None:
+            return geocode_google(address)
+        return address_memo.get_or_compute(normalize_query(address), lambda: geocode_google(address))
+    
+    with ThreadPoolExecutor(max_workers=min(GEOCODE_WORKERS, len(sample))) as executor:
+        google_points = list(executor.map(google_point, sample))
+    
+    pairs = [(result['coords'], point) for result, point in zip(sample, google_points) if point]
+    if not pairs:
+        return len(pending), []
+    offsets = haversine_m(
+        [local[0] for local, _ in pairs], [local[1] for local, _ in pairs],
+        [point['lat'] for _, point in pairs], [point['lng'] for _, point in pairs],
+    )
+    return len(pending), [float(offset) for offset in offsets]
+
+def gazetteer_result(entry):
+    """Result for a row answered from a gazetteer entry, with the URLs a provider lookup would have built"""
+    if entry['place_id']:
+        address = ""
+        direct, embed = build_google_urls_from_place_id(entry['place_id'])
+    else:
+        address = entry['address']
+        direct, embed = build_google_urls_from_address(address)
+    return {
+        'address': address,
+        'direct': direct,
+        'embed': embed,
+        'coords': (entry['lat'], entry['lng']),
+        'gcj02': None,
+        'provider': None,
+        'lookups': 0,
+        'seconds': 0.0
+    }
+
+def skipped_result():
+    """Empty result for a row without a venue name, which is not looked up"""
+    return {
+        'address': '',
+        'direct': '',
+        'embed': '',
+        'coords': None,
+        'gcj02': None,
+        'provider': None,
+        'lookups': 0,
+        'seconds': 0.0
+    }
+
+# ============================================================
+# WORKFLOW REQUIREMENT: Output must have ONLY these 5 columns
+# in this exact order:
+# 1. city
+# 2. venue
+# 3. address
+# 4. google_maps_embed_url
+# 5. google_maps_direct_url
+# ============================================================
+OUTPUT_COLUMNS = ['city', 'venue', 'address', 'google_maps_embed_url', 'google_maps_direct_url']
+
+def output_row(city, place, result):
+    """Values of one output row, in OUTPUT_COLUMNS order"""
+    return [city, place, result['address'], result['embed'], result['direct']]
+
+def is_output_format(columns):
+    """True for a sheet in this tool's own output format (a re-uploaded *_output.xlsx)"""
+    return [str(col).strip().lower() for col in columns[:len(OUTPUT_COLUMNS)]] == OUTPUT_COLUMNS
+
+def carried_result(row, full_name: str, meta: dict):
+    """
+    Result kept from an earlier output row (city, venue, address, embed URL, direct URL), or None
+    when the row must be resolved again: it is new, its city/venue, address or URLs changed since
+    the workbook was written, or its URLs are empty
+    """
+    row = tuple(row) + (None,) * (len(OUTPUT_COLUMNS) - len(row))
+    address, embed, direct = row[2:5]
+    if not direct:
+        return None
+    coords = recorded_coords(meta, normalize_query(full_name), row)
+    if coords is None:
+        return None
+    return {
+        'address': address or '',
+        'direct': direct,
+        'embed': embed or '',
+        'coords': coords if coords[0] is not None else None,
+        'gcj02': None,
+        'provider': None,
+        'lookups': 0,
+        'seconds': 0.0
+    }
+
+def iter_resolved(pairs, resolver: VenueResolver, chunk_size: int = None, checkpoint=None, on_row=None,
+                  meta: dict = None):
+    """
+    Resolve a stream of (city, place) pairs chunk by chunk
+    Each chunk is normalized in one vectorized pass (normalize_pairs): the canonical query is what
+    providers, the dedup stage and the geocode cache see, and rows without a venue are skipped
+    Venues already in the local gazetteer are answered from it; newly resolved ones are added to it
+    Rows already stored in checkpoint are reused; new results are recorded as they resolve
+    With meta (from an earlier output workbook), pairs carry the whole output row as a third item
+    and unchanged rows are carried over instead of resolved (see carried_result)
+    on_row(row_idx, full_name, result, source) is called for every row as its result is known, with
+    source 'resumed', 'skipped', 'carried', 'gazetteer' or 'lookup' (from worker threads, as each
+    provider lookup finishes)
+    Yields (city, place, full_name, result) in input order; only one chunk of rows is held in memory,
+    next to the resolver's bounded memos
+    """
+    start = 0
+    for chunk in iter_chunks(pairs, chunk_size):
+        normalized = normalize_pairs([item[0] for item in chunk], [item[1] for item in chunk])
+        full_names = normalized['query'].tolist()
+        
+        results = [None] * len(chunk)
         
+        def report(indices, source, start=start, full_names=full_names, results=results):
+            # Reported before the counters move, so a progress callback sees the rows it counts
+            if on_row is not None:
+                for idx in indices:
+                    on_row(start + idx, full_names[idx], results[idx], source)
+        
+        stored = checkpoint.load(start, start + len(chunk)) if checkpoint is not None else {}
+        if stored:
+            # Checkpointed rows from local coordinate mode may still hold GCJ-02 points
+            convert_amap_coords(list(stored.values()), sample_size=0)
+            for row_idx, result in stored.items():
+                results[row_idx - start] = result
+            report([row_idx - start for row_idx in stored], 'resumed')
+            resolver.add_resumed(len(stored))
+        
+        skipped = []
+        for idx, blank in enumerate(normalized['blank'].tolist()):
+            if blank and results[idx] is None:
+                results[idx] = skipped_result()
+                skipped.append(idx)
+        if skipped:
+            report(skipped, 'skipped')
+            resolver.add_skipped(len(skipped))
+        
+        if meta:
+            carried = []
+            for idx, item in enumerate(chunk):
+                if results[idx] is None:
+                    results[idx] = carried_result(item[2], full_names[idx], meta)
+                    if results[idx] is not None:
+                        carried.append(idx)
+            report(carried, 'carried')
+            resolver.add_carried(len(carried))
+        
+        keys, cities, places = (normalized[name].tolist() for name in ('key', 'city', 'place'))
+        missing = [idx for idx in range(len(chunk)) if results[idx] is None]
+        if missing and GAZETTEER.enabled:
+            known = GAZETTEER.lookup([keys[idx] for idx in missing], [cities[idx] for idx in missing],
+                                     [places[idx] for idx in missing])
+            answered = []
+            for idx, entry in zip(missing, known):
+                if entry is not None:
+                    results[idx] = gazetteer_result(entry)
+                    answered.append(idx)
+            if answered:
+                report(answered, 'gazetteer')
+                resolver.add_gazetteer(len(answered))
+                missing = [idx for idx in missing if results[idx] is None]
+        
+        on_rows_done = None
+        if checkpoint is not None or on_row is not None:
+            def on_rows_done(rows, result, start=start, missing=missing, full_names=full_names):
+                if checkpoint is not None:
+                    checkpoint.record([(start + missing[i], result) for i in rows])
+                if on_row is not None:
+                    for i in rows:
+                        on_row(start + missing[i], full_names[missing[i]], result, 'lookup')
+        
+        resolved = resolver.resolve_chunk(
+            [full_names[idx] for idx in missing],
+            on_rows_done=on_rows_done,
+            cities=[chunk[idx][0] for idx in missing],
+        )
+        for idx, result in zip(missing, resolved):
+            results[idx] = result
+        GAZETTEER.record(
+            [(keys[idx], cities[idx], places[idx], result['address'], result['direct'], result['coords'])
+             for idx, result in zip(missing, resolved) if result['provider'] is not None],
+            source='lookup',
+        )
+        
+        for item, full_name, result in zip(chunk, full_names, results):
+            yield item[0], item[1], full_name, result
+        start += len(chunk)
+
+def resolve_records(records, chunk_size: int = None):
+    """
+    Resolve (city, venue) pairs for the JSON API, with the same logic as process_venue_file
+    Yields one dict per record, in input order, with the output columns plus KML coordinates
+    """
+    resolver = VenueResolver(total=len(records))
+    try:
+        for index, (city, place, full_name, result) in enumerate(iter_resolved(records, resolver, chunk_size=chunk_size)):
+            item = dict(zip(OUTPUT_COLUMNS, output_row(city, place, result)))
+            lat, lng = result['coords'] if result['coords'] is not None else (None, None)
+            item.update({'index': index, 'lat': lat, 'lng': lng})
+            ROWS_PROCESSED.inc()
+            yield item
+    finally:
+        resolver.close()
+
+def open_venue_input(input_path: str):
+    """
+    Open a venue file and pick its city and venue columns
+    Returns a dict with the lazy (city, place) 'pairs' for iter_resolved, the estimated row 'total',
+    whether the file is a re-uploaded 'output_format' workbook and its carry-over 'meta' (or None)
+    """
+    columns, rows, total = open_venue_rows(input_path)
+    # A re-uploaded output workbook: rows whose city/venue are unchanged keep their results
+    output_format = is_output_format(columns)
+    meta = read_output_meta(input_path) if output_format else None
+    if output_format:
+        city_idx, place_idx = 0, 1
+        if meta is None:
+            print("Input is an output workbook without its hidden metadata sheet; resolving every row again")
+        else:
+            print("Input is an output workbook: rows with unchanged city/venue and URLs are carried over")
+    else:
+        city_col, place_col = detect_header_columns(columns)
+        city_idx, place_idx = columns.index(city_col), columns.index(place_col)
+    
+    def cell(row, idx):
+        return row[idx] if idx < len(row) else None
+    
+    if meta:
+        pairs = ((cell(row, city_idx), cell(row, place_idx), row) for row in rows)
+    else:
+        pairs = ((cell(row, city_idx), cell(row, place_idx)) for row in rows)
+    return {'pairs': pairs, 'total': total, 'output_format': output_format, 'meta': meta}
+
+def output_filenames(input_path: str, output_format: bool = False):
+    """(Excel, KML) output file names for an input file"""
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    if output_format and base_name.endswith('_output'):
+        # venues_output.xlsx comes back as venues_output.xlsx, not venues_output_output.xlsx
+        base_name = base_name[:-len('_output')]
+    excel_filename = f"{base_name}_output.xlsx"
+    kml_filename = f"{base_name}.kmz" if KML_FORMAT == 'kmz' else f"{base_name}.kml"
+    return excel_filename, kml_filename
+
+def process_venue_file(input_path: str, output_dir: str, progress=None, on_row=None):
+    """
+    Process an Excel (.xlsx/.xls) or CSV file with venue data
+    Rows are streamed from the input, resolved in chunks and streamed to the output workbook
+    progress(done, total) is called as rows are resolved, on_row(row_idx, full_name, result, source) for every row (see iter_resolved)
+    Returns a dictionary with success status, file paths, run stats and per-stage timings
+    """
+    timings = StageTimings()
+    try:
+        with timings.stage('read'):
+            venue_input = open_venue_input(input_path)
+        output_format, meta, total = venue_input['output_format'], venue_input['meta'], venue_input['total']
+        # Time spent pulling rows from the input counts as 'read', the rest of each chunk as 'resolve'
+        pairs = timings.wrap('read', venue_input['pairs'])
+        
+        excel_filename, kml_filename = output_filenames(input_path, output_format)
         excel_path = os.path.join(output_dir, excel_filename)
         kml_path = os.path.join(output_dir, kml_filename)
         
-        output_df.to_excel(excel_path, index=False)
+        # Output must have ONLY the 5 OUTPUT_COLUMNS, in that exact order
+        excel_writer = ExcelOutputWriter(excel_path, OUTPUT_COLUMNS)
+        # Placemarks are streamed to disk as rows resolve
+        kml_writer = KmlWriter(kml_path, kmz=KML_FORMAT == 'kmz')
+        
+        if progress is not None:
+            progress(0, total or 0)
+        
+        # Per-row results are checkpointed so a re-submitted file resumes where it stopped
+        checkpoint = open_checkpoint(input_path)
+        if checkpoint is not None and checkpoint.resumable:
+            print(f"Resuming: {checkpoint.resumable} rows already resolved in an earlier run")
+        
+        # Rows are resolved concurrently; results come back in row order
+        resolver = VenueResolver(progress=progress, total=total)
+        resolved = timings.wrap('resolve', iter_resolved(pairs, resolver, checkpoint=checkpoint, on_row=on_row,
+                                                         meta=meta))
+        try:
+            for city, place, full_name, result in resolved:
+                with timings.stage('excel'):
+                    excel_writer.append(output_row(city, place, result), key=normalize_query(full_name),
+                                        coords=result['coords'])
+                if result['coords'] is not None:
+                    lat, lng = result['coords']
+                    with timings.stage('kml'):
+                        kml_writer.add(lat, lng, full_name, city=city)
+        except BaseException:
+            excel_writer.abort()
+            kml_writer.abort()
+            raise
+        finally:
+            resolver.close()
+        
+        run_stats = resolver.stats()
+        print(f"Dedup: {run_stats['unique_queries']} unique queries for {run_stats['rows']} rows, "
+              f"{run_stats['lookups_saved']} provider lookups saved")
+        if run_stats['skipped_rows']:
+            print(f"Skipped {run_stats['skipped_rows']} rows without a venue name")
+        if run_stats['gazetteer_rows']:
+            print(f"Gazetteer: answered {run_stats['gazetteer_rows']} rows from known venues")
+        if output_format:
+            not_resolved = sum(run_stats[name] for name in ('carried_rows', 'resumed_rows', 'skipped_rows', 'gazetteer_rows'))
+            print(f"Carried over {run_stats['carried_rows']} unchanged rows, "
+                  f"resolved {run_stats['rows'] - not_resolved}")
+        if 'gcj02' in run_stats:
+            gcj02 = run_stats['gcj02']
+            print(f"GCJ-02 -> WGS-84: converted {gcj02['converted']} Amap points locally")
+            if gcj02['sampled']:
+                print(f"  Offset vs Google on {gcj02['sampled']} samples: mean {gcj02['mean_offset_m']} m, "
+                      f"median {gcj02['median_offset_m']} m, max {gcj02['max_offset_m']} m")
+        if 'hedges' in run_stats:
+            hedges = run_stats['hedges']
+            print(f"Hedging ({resolver.hedge.mode}): {hedges['hedged']} early Amap searches, {hedges['used']} used, "
+                  f"{hedges['wasted']} wasted, {hedges['cancelled']} cancelled")
+        if progress is not None:
+            progress(run_stats['rows'], run_stats['rows'])
+        
+        with timings.stage('excel'):
+            excel_writer.close()
         print(f"Generated: {excel_path}")
         
-        placemarks = []
-        for lat, lng, name in coords_for_kml:
-            placemark = f"""
-    <Placemark>
-        <name>{name}</name>
-        <Point>
-            <coordinates>{lng},{lat},0</coordinates>
-        </Point>
-    </Placemark>"""
-            placemarks.append(placemark)
-        
-        kml_content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<kml xmlns="http://www.opengis.net/kml/2.2">
-<Document>
-{''.join(placemarks)}
-</Document>
-</kml>
-"""
-        
-        with open(kml_path, "w", encoding="utf-8") as f:
-            f.write(kml_content)
+        with timings.stage('kml'):
+            kml_writer.close()
         print(f"Generated: {kml_path}")
+        for line in summary_lines(kml_writer.summary):
+            print(line)
+        run_stats['kml'] = kml_writer.summary
+        
+        if checkpoint is not None:
+            checkpoint.finish()
+        
+        cache_stats = GEOCODE_CACHE.stats()
+        print(f"Geocode cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+              f"{cache_stats['entries']} entries")
+        
+        stage_timings = timings.summary()
+        for stage, seconds in stage_timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        ROWS_PROCESSED.inc(run_stats['rows'])
+        print("Timings: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in stage_timings.items()))
         
         return {
             'success': True,
             'excel_path': excel_path,
             'kml_path': kml_path,
             'excel_filename': excel_filename,
-            'kml_filename': kml_filename
+            'kml_filename': kml_filename,
+            'stats': run_stats,
+            'timings': stage_timings
         }
         
     except Exception as e:
@@ -0,0 +1,207 @@
+import csv
+import hashlib
+import os
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+# Rows resolved together between reads and writes
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', '1000'))
+# Output workbooks carry a hidden sheet of per-row query keys and coordinates,
+# so a re-uploaded output only re-resolves the rows that were edited
+OUTPUT_META = os.environ.get('OUTPUT_META', '1') != '0'
+
+# Name of the hidden sheet; it is 'veryHidden', so Excel's Unhide dialog does not list it
+META_SHEET = '_geocoder'
+META_COLUMNS = ['query', 'lat', 'lng', 'fingerprint']
+# Output columns covered by a row's fingerprint: address, embed URL and direct URL
+_FINGERPRINT_COLUMNS = slice(2, 5)
+
+# CSV encodings tried in turn: UTF-8 (with or without BOM), then GB18030 (a superset of
+# GBK/GB2312, what Excel on Chinese Windows saves as "CSV")
+_CSV_ENCODINGS = ('utf-8-sig', 'gb18030')
+
+# Same look as the header pandas.DataFrame.to_excel writes
+_HEADER_FONT = Font(bold=True)
+_HEADER_BORDER = Border(*(Side(style='thin'),) * 4)
+_HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+
+
+def _header_names(values):
+    """Header cells as column names, naming blank cells the way pandas does"""
+    return [
+        str(value) if value is not None and str(value).strip() != '' else f"Unnamed: {i}"
+        for i, value in enumerate(values)
+    ]
+
+
+def _is_blank(row):
+    return all(value is None or (isinstance(value, str) and value.strip() == '') for value in row)
+
+
+def open_venue_rows(input_path: str):
+    """
+    Open an .xlsx, .xls or .csv file for streaming
+    Returns (column names, iterator of row value tuples, estimated row count or None)
+    Rows are read lazily; fully blank rows are skipped
+    """
+    ext = os.path.splitext(input_path)[1].lower()
+
+    if ext == '.csv':
+        # A quick first pass for the header and row count keeps progress/ETA meaningful,
+        # and finds the first encoding the whole file decodes with
+        for encoding in _CSV_ENCODINGS:
+            try:
+                with open(input_path, newline='', encoding=encoding) as f:
+                    reader = csv.reader(f)
+                    header = next(reader, [])
+                    total = sum(1 for _ in reader)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError("Cannot read the CSV file's text encoding. Save it as UTF-8 and upload it again.")
+
+        def csv_rows():
+            with open(input_path, newline='', encoding=encoding) as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    row = [value if value != '' else None for value in row]
+                    if not _is_blank(row):
+                        yield tuple(row)
+
+        return _header_names(header), csv_rows(), total
+
+    if ext == '.xls':
+        # Legacy format: openpyxl can't stream it, so fall back to pandas
+        df = pd.read_excel(input_path)
+        rows = (tuple(None if pd.isna(value) else value for value in row)
+                for row in df.itertuples(index=False, name=None))
+        return [str(col) for col in df.columns], rows, len(df)
+
+    wb = load_workbook(input_path, read_only=True, data_only=True)
+    ws = wb.active
+    total = ws.max_row - 1 if ws.max_row else None
+    sheet_rows = ws.iter_rows(values_only=True)
+    header = next(sheet_rows, ())
+
+    def xlsx_rows():
+        try:
+            for row in sheet_rows:
+                if not _is_blank(row):
+                    yield row
+        finally:
+            wb.close()
+
+    return _header_names(header), xlsx_rows(), total
+
+
+def iter_chunks(rows, size: int = None):
+    """Group an iterator of rows into lists of at most size rows"""
+    size = size or STREAM_CHUNK_ROWS
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def row_fingerprint(values) -> str:
+    """Short hash of an output row's address and map URLs, the same for the written and the read-back row"""
+    values = (tuple(values) + (None,) * _FINGERPRINT_COLUMNS.stop)[_FINGERPRINT_COLUMNS]
+    text = '\x1f'.join('' if value is None else str(value) for value in values)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def recorded_coords(meta: dict, key: str, row):
+    """
+    (lat, lng) recorded for an output row whose key, address and URLs are unchanged ((None, None) if it
+    had no KML point), or None for a new or edited row: a row edited to another venue of the file keeps
+    the old venue's URLs, which do not match what was recorded for the new key
+    """
+    return meta.get(key, {}).get(row_fingerprint(row))
+
+
+def read_output_meta(input_path: str):
+    """
+    {query key: {row fingerprint: (lat, lng)}} from the hidden sheet of an earlier output workbook
+    lat/lng are None for rows that had no KML point; returns None when the file has no such sheet
+    Workbooks written before fingerprints were recorded match no row (see recorded_coords)
+    """
+    if os.path.splitext(input_path)[1].lower() != '.xlsx':
+        return None
+    wb = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        if META_SHEET not in wb.sheetnames:
+            return None
+        rows = wb[META_SHEET].iter_rows(values_only=True)
+        next(rows, None)
+        meta = {}
+        for row in rows:
+            row = tuple(row) + (None,) * (len(META_COLUMNS) - len(row))
+            key, lat, lng, fingerprint = row[:4]
+            if key is None or fingerprint is None:
+                continue
+            coords = (float(lat), float(lng)) if lat is not None and lng is not None else (None, None)
+            meta.setdefault(str(key), {})[str(fingerprint)] = coords
+        return meta
+    finally:
+        wb.close()
+
+
+class ExcelOutputWriter:
+    """
+    Appends output rows to a write-only workbook so memory stays flat
+    With meta enabled, a hidden sheet records each row's query key, coordinates and fingerprint
+    (see read_output_meta)
+    """
+
+    def __init__(self, path: str, columns, meta: bool = None):
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('Sheet1')
+        header = []
+        for name in columns:
+            cell = WriteOnlyCell(self.sheet, value=name)
+            cell.font = _HEADER_FONT
+            cell.border = _HEADER_BORDER
+            cell.alignment = _HEADER_ALIGNMENT
+            header.append(cell)
+        self.sheet.append(header)
+        self.meta_sheet = None
+        if OUTPUT_META if meta is None else meta:
+            self.meta_sheet = self.workbook.create_sheet(META_SHEET)
+            self.meta_sheet.sheet_state = 'veryHidden'
+            self.meta_sheet.append(META_COLUMNS)
+        self.rows = 0
+
+    def append(self, values, key: str = None, coords=None):
+        """Write one row; key, coords (lat, lng) and the row's fingerprint go to the hidden sheet"""
+        values = list(values)
+        self.sheet.append(values)
+        if self.meta_sheet is not None and key is not None:
+            lat, lng = coords if coords is not None else (None, None)
+            self.meta_sheet.append([key, lat, lng, row_fingerprint(values)])
+        self.rows += 1
+
+    def close(self):
+        self.workbook.save(self.path)
+
+    def abort(self):
+        """Discard a half-written workbook, including openpyxl's temporary sheet file"""
+        for sheet in (self.sheet, self.meta_sheet):
+            if sheet is None:
+                continue
+            try:
+                sheet.close()
+            except Exception:
+                pass
+            out = getattr(getattr(sheet, '_writer', None), 'out', None)
+            if out and os.path.exists(out):
+                os.remove(out)